@@ -0,0 +1,23 @@
+# Path: atoms.py
+from typing import Dict, Iterable
+
+import xcffib
+
+__all__ = ['AtomRegistry']
+
+
+class AtomRegistry:
+    """
+    Interns a set of atoms with a single round trip: every InternAtom request is sent first and
+    the replies are collected afterwards.
+    """
+
+    def __init__(self, conn: xcffib.Connection, names: Iterable[str]):
+        cookies = {name: conn.core.InternAtom(False, len(name), name) for name in names}
+        self._atoms: Dict[str, int] = {name: cookie.reply().atom for name, cookie in cookies.items()}
+
+    def __getitem__(self, name: str) -> int:
+        return self._atoms[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._atoms
@@ -0,0 +1,70 @@
+# Path: backoff.py
+import collections
+import logging
+import random
+import time
+from typing import Deque, Optional
+
+__all__ = ['Backoff']
+
+
+class Backoff:
+    """
+    Jittered exponential restart delay with crash-loop detection.
+
+    A run that lasts at least `healthy_after` seconds resets the delay to `initial`.
+    When `crash_loop_count` short runs happen within `crash_loop_window` seconds the
+    process is considered crash looping and the delay becomes `crash_loop_delay`.
+    """
+
+    def __init__(self,
+                 name: str,
+                 initial: float = 1.0,
+                 maximum: float = 60.0,
+                 factor: float = 2.0,
+                 jitter: float = 0.2,
+                 healthy_after: float = 60.0,
+                 crash_loop_count: int = 5,
+                 crash_loop_window: float = 120.0,
+                 crash_loop_delay: float = 300.0):
+        self.name = name
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.healthy_after = healthy_after
+        self.crash_loop_count = crash_loop_count
+        self.crash_loop_window = crash_loop_window
+        self.crash_loop_delay = crash_loop_delay
+        self._attempt = 0
+        self._short_runs: Deque[float] = collections.deque()
+
+    @property
+    def crash_looping(self) -> bool:
+        return len(self._short_runs) >= self.crash_loop_count
+
+    def next_delay(self, run_time: float, now: Optional[float] = None) -> float:
+        """
+        :param run_time: how long the last run lasted, in seconds
+        :return: seconds to wait before the next start
+        """
+        if now is None:
+            now = time.monotonic()
+        if run_time >= self.healthy_after:
+            self._attempt = 0
+            self._short_runs.clear()
+        else:
+            self._short_runs.append(now)
+        while self._short_runs and now - self._short_runs[0] > self.crash_loop_window:
+            self._short_runs.popleft()
+
+        if self.crash_looping:
+            logging.warning(
+                f"{self.name}: {len(self._short_runs)} short runs in {self.crash_loop_window:.0f} seconds, "
+                f"crash loop: backing off {self.crash_loop_delay:.0f} seconds"
+            )
+            delay = self.crash_loop_delay
+        else:
+            delay = min(self.maximum, self.initial * (self.factor ** self._attempt))
+            self._attempt += 1
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
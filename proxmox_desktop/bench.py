@@ -0,0 +1,428 @@
+# Path: bench.py
+"""
+Headless end-to-end benchmark: MWM attached to an Xvfb server, a fake Proxmox API answering in-process
+with injectable latency and a stub remote-viewer that maps and resizes a window like the real one.
+
+    python -m proxmox_desktop.bench --xvfb --runs 5 --api-latency 0.02 --output bench.json
+
+Reports, as JSON, the time from the start of the WM to the first mapped viewer window, the reconnect
+latency (viewer killed -> next viewer window mapped) and the ConfigureRequest handling throughput.
+"""
+import argparse
+import json
+import logging
+import os
+import select
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import xcffib
+import xcffib.xproto
+
+from proxmox_desktop.proxmox_desktop import MWM
+from proxmox_desktop.proxmox_viewer import ProxmoxViewer
+
+__all__ = ['FakeProxmoxAPI', 'run_benchmark', 'start_xvfb', 'main']
+
+_STUB_WINDOW_NAME = "bench remote-viewer"
+
+_STUB_SCRIPT = """#!/bin/sh
+exec "{python}" -m proxmox_desktop.bench stub-viewer "$@"
+"""
+
+
+class _FakeResource:
+    def __init__(self, api: "FakeProxmoxAPI", path: Tuple[str, ...]):
+        self._fake_api = api
+        self._path = path
+
+    def __getattr__(self, name: str) -> "_FakeResource":
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _FakeResource(self._fake_api, self._path + (name,))
+
+    def __call__(self, *segments: Any) -> "_FakeResource":
+        return _FakeResource(self._fake_api, self._path + tuple(str(s) for s in segments))
+
+    def get(self, **params):
+        return self._fake_api.request('GET', self._path, params)
+
+    def post(self, **params):
+        return self._fake_api.request('POST', self._path, params)
+
+
+class FakeProxmoxAPI:
+    """
+    In-process stand-in for ProxmoxAPI, answering the calls ProxmoxViewer makes:
+    cluster/resources, cluster/status, nodes/{node}/qemu/{vmid}/status/current, status/start,
+    nodes/{node}/tasks/{upid}/status and spiceproxy. Every call sleeps `latency` seconds first.
+    """
+
+    def __init__(self, vms: Dict[int, str], latency: float = 0.0, running: bool = True, start_time: float = 0.0):
+        """
+        :param vms: vmid -> node
+        :param running: initial state of the VMs
+        :param start_time: seconds a started VM takes to report running
+        """
+        self.latency = latency
+        self.start_time = start_time
+        self.calls: Counter = Counter()
+        self._vms = dict(vms)
+        self._running_at: Dict[int, Optional[float]] = {vmid: 0.0 if running else None for vmid in vms}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> _FakeResource:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _FakeResource(self, (name,))
+
+    def get_tokens(self) -> Tuple[None, None]:
+        return None, None
+
+    def _status(self, vmid: int) -> str:
+        running_at = self._running_at[vmid]
+        return 'running' if running_at is not None and time.monotonic() >= running_at else 'stopped'
+
+    def request(self, method: str, path: Sequence[str], params: Dict[str, Any]) -> Any:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            return self._answer(method, tuple(path), params)
+
+    def _answer(self, method: str, path: Tuple[str, ...], params: Dict[str, Any]) -> Any:
+        if path == ('cluster', 'resources'):
+            self.calls['cluster/resources'] += 1
+            return [
+                {'type': 'qemu', 'id': f"qemu/{vmid}", 'vmid': vmid, 'node': node, 'status': self._status(vmid)}
+                for vmid, node in self._vms.items()
+            ]
+        if path == ('cluster', 'status'):
+            self.calls['cluster/status'] += 1
+            return [
+                {'type': 'node', 'name': node, 'ip': '127.0.0.1', 'online': 1}
+                for node in sorted(set(self._vms.values()))
+            ]
+        if len(path) >= 4 and path[0] == 'nodes' and path[2] == 'qemu':
+            vmid = int(path[3])
+            if self._vms.get(vmid) != path[1]:
+                raise ValueError(f"VM {vmid} does not exist on {path[1]}")
+            endpoint = "nodes/{node}/qemu/{vmid}/" + "/".join(path[4:])
+            self.calls[endpoint] += 1
+            if path[4:] == ('status', 'current') and method == 'GET':
+                status = self._status(vmid)
+                return {'vmid': vmid, 'status': status, 'qmpstatus': status}
+            if path[4:] == ('status', 'start') and method == 'POST':
+                if self._running_at[vmid] is None:
+                    self._running_at[vmid] = time.monotonic() + self.start_time
+                return f"UPID:{path[1]}:00000000:00000000:00000000:qmstart:{vmid}:root@pam:"
+            if path[4:] == ('spiceproxy',) and method == 'POST':
+                proxy = params.get('proxy', path[1])
+                return {
+                    'type': 'spice',
+                    'host': f"pvespiceproxy:{vmid}",
+                    'password': 'bench',
+                    'proxy': f"http://{proxy}:3128",
+                    'tls-port': 61000,
+                    'title': f"VM {vmid}",
+                    'delete-this-file': 1,
+                    'toggle-fullscreen': 'Shift+F11',
+                    'release-cursor': 'Ctrl+Alt+R',
+                    'secure-attention': 'Ctrl+Alt+Ins',
+                }
+        if len(path) == 5 and path[0] == 'nodes' and path[2] == 'tasks' and path[4] == 'status':
+            self.calls['nodes/{node}/tasks/{upid}/status'] += 1
+            return {'status': 'stopped', 'exitstatus': 'OK', 'upid': path[3]}
+        raise ValueError(f"{method} {'/'.join(path)} not implemented by the fake API")
+
+
+def stub_viewer(argv: List[str]) -> int:
+    """
+    Stand-in for remote-viewer: reads the connection file, maps a window, resizes it to a guest
+    resolution then to the screen size once mapped, and runs until its X connection is closed.
+    """
+    display = None
+    path = None
+    for arg in argv:
+        if arg.startswith('--display='):
+            display = arg.split('=', 1)[1]
+        elif not arg.startswith('-'):
+            path = arg
+    if path is None:
+        print("stub-viewer: no connection file", file=sys.stderr)
+        return 2
+    with open(path) as f:
+        if not f.read().startswith("[virt-viewer]"):
+            print(f"stub-viewer: {path} is not a virt-viewer file", file=sys.stderr)
+            return 2
+
+    conn = xcffib.connect(display=display)
+    screen = conn.get_setup().roots[0]
+    window = conn.generate_id()
+    conn.core.CreateWindow(
+        screen.root_depth, window, screen.root,
+        0, 0, 640, 480, 0,
+        xcffib.xproto.WindowClass.InputOutput,
+        screen.root_visual,
+        xcffib.xproto.CW.BackPixel | xcffib.xproto.CW.EventMask,
+        [screen.black_pixel, xcffib.xproto.EventMask.StructureNotify]
+    )
+    name = _STUB_WINDOW_NAME.encode()
+    conn.core.ChangeProperty(
+        xcffib.xproto.PropMode.Replace, window,
+        xcffib.xproto.Atom.WM_NAME, xcffib.xproto.Atom.STRING, 8, len(name), name
+    )
+    conn.core.MapWindow(window)
+    conn.flush()
+    resized = False
+    try:
+        while True:
+            event = conn.wait_for_event()
+            if isinstance(event, xcffib.xproto.MapNotifyEvent) and not resized:
+                resized = True
+                for width, height in ((1024, 768), (screen.width_in_pixels, screen.height_in_pixels)):
+                    conn.core.ConfigureWindow(
+                        window,
+                        xcffib.xproto.ConfigWindow.Width | xcffib.xproto.ConfigWindow.Height,
+                        [width, height]
+                    )
+                conn.flush()
+    except xcffib.ConnectionException:
+        # killed by the benchmark: the session is over
+        return 0
+
+
+def start_xvfb(screen: str = "1920x1080x24", timeout: float = 10.0) -> Tuple[Any, str]:
+    """
+    Start Xvfb on a free display.
+    :return: the process and its display
+    """
+    import subprocess
+    displayfd_r, displayfd_w = os.pipe()
+    try:
+        proc = subprocess.Popen(
+            ["Xvfb", "-screen", "0", screen, "-nolisten", "tcp", "-displayfd", str(displayfd_w)],
+            pass_fds=(displayfd_w,)
+        )
+    finally:
+        os.close(displayfd_w)
+    try:
+        data = b""
+        deadline = time.monotonic() + timeout
+        while b"\n" not in data:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([displayfd_r], [], [], remaining)[0]:
+                proc.kill()
+                raise RuntimeError(f"Xvfb not ready after {timeout} seconds")
+            chunk = os.read(displayfd_r, 64)
+            if not chunk:
+                raise RuntimeError(f"Xvfb exited with code {proc.wait()}")
+            data += chunk
+    finally:
+        os.close(displayfd_r)
+    return proc, f":{data.decode().strip()}"
+
+
+class _Observer:
+    """
+    Second X client following the windows mapped on the root window, as the user would see them.
+    """
+
+    def __init__(self, display: str):
+        self.conn = xcffib.connect(display=display)
+        self.root = self.conn.get_setup().roots[0].root
+        self.conn.core.ChangeWindowAttributesChecked(
+            self.root, xcffib.xproto.CW.EventMask, [xcffib.xproto.EventMask.SubstructureNotify]
+        ).check()
+
+    def _is_stub_window(self, window: int) -> bool:
+        try:
+            reply = self.conn.core.GetProperty(
+                False, window, xcffib.xproto.Atom.WM_NAME, xcffib.xproto.Atom.STRING, 0, 64
+            ).reply()
+        except xcffib.ProtocolException:
+            # the window is already gone
+            return False
+        return reply.value.to_string() == _STUB_WINDOW_NAME
+
+    def wait_viewer_mapped(self, timeout: float) -> Tuple[int, float]:
+        """
+        :return: the viewer window mapped next and the time it was seen
+        """
+        deadline = time.monotonic() + timeout
+        fd = self.conn.get_file_descriptor()
+        while True:
+            event = self.conn.poll_for_event()
+            if event is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"no viewer window mapped in {timeout} seconds")
+                select.select([fd], [], [], remaining)
+                continue
+            if isinstance(event, xcffib.xproto.MapNotifyEvent) and not event.override_redirect:
+                seen_at = time.monotonic()
+                if self._is_stub_window(event.window):
+                    return event.window, seen_at
+
+    def configure_burst(self, window: int, count: int):
+        for i in range(count):
+            size = 800 + i % 2 * 100
+            self.conn.core.ConfigureWindow(
+                window,
+                xcffib.xproto.ConfigWindow.Width | xcffib.xproto.ConfigWindow.Height,
+                [size, size]
+            )
+        self.conn.flush()
+
+    def kill(self, window: int):
+        self.conn.core.KillClient(window)
+        self.conn.flush()
+
+    def close(self):
+        self.conn.disconnect()
+
+
+def _configure_requests(wm: MWM) -> int:
+    for stats in wm.event_stats():
+        if stats.name == 'ConfigureRequestEvent':
+            return stats.count
+    return 0
+
+
+def _summary(samples: List[float]) -> Dict[str, Any]:
+    if not samples:
+        return {'samples': 0}
+    return {
+        'samples': len(samples),
+        'min': round(min(samples), 3),
+        'median': round(statistics.median(samples), 3),
+        'max': round(max(samples), 3),
+    }
+
+
+def run_benchmark(display: str,
+                  vmid: int = 101,
+                  reconnects: int = 5,
+                  api_latency: float = 0.0,
+                  configure_events: int = 2000,
+                  timeout: float = 30.0) -> Dict[str, Any]:
+    """
+    One run: start the WM, wait for the first viewer window, measure the ConfigureRequest throughput,
+    then kill the viewer `reconnects` times and measure how long the next window takes to show up.
+    All times are in milliseconds.
+    """
+    api = FakeProxmoxAPI({vmid: 'bench'}, latency=api_latency)
+    with tempfile.TemporaryDirectory(prefix="proxmox-desktop-bench-") as tmpdir:
+        stub = os.path.join(tmpdir, "remote-viewer")
+        with open(stub, 'w') as f:
+            f.write(_STUB_SCRIPT.format(python=sys.executable))
+        os.chmod(stub, 0o755)
+
+        viewer = ProxmoxViewer(api=api, remote_viewer_path=stub)
+        # the viewer is killed on purpose: reconnect without backoff
+        viewer.restart_healthy_after = 0.0
+        observer = _Observer(display)
+        wm = MWM(vmid, display=display, run_xserver=False, proxmox=viewer, warm_reconnect=True)
+        try:
+            started_at = time.monotonic()
+            wm.start()
+            window, mapped_at = observer.wait_viewer_mapped(timeout)
+            first_map = (mapped_at - started_at) * 1000
+
+            # let the resizes of the stub go through before the burst
+            time.sleep(0.2)
+            base = _configure_requests(wm)
+            burst_start = time.monotonic()
+            observer.configure_burst(window, configure_events)
+            deadline = burst_start + timeout
+            while _configure_requests(wm) < base + configure_events:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("ConfigureRequest burst not handled in time")
+                time.sleep(0.001)
+            burst_time = time.monotonic() - burst_start
+
+            reconnect_times = []
+            for _ in range(reconnects):
+                killed_at = time.monotonic()
+                observer.kill(window)
+                window, mapped_at = observer.wait_viewer_mapped(timeout)
+                reconnect_times.append((mapped_at - killed_at) * 1000)
+        finally:
+            wm.stop()
+            wm.join(timeout)
+            wm.__exit__(None, None, None)
+            observer.close()
+
+    return {
+        'time_to_first_mapped_window_ms': round(first_map, 3),
+        'reconnect_ms': _summary(reconnect_times),
+        'configure_requests_per_second': round(configure_events / burst_time, 1),
+        'api_calls': dict(api.calls),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'stub-viewer':
+        sys.exit(stub_viewer(argv[1:]))
+
+    parser = argparse.ArgumentParser(prog='proxmox-desktop-bench', description=__doc__.split('\n\n')[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--display', help='X server to run against, e.g. an Xvfb already running')
+    target.add_argument('--xvfb', action='store_true', help='start Xvfb for every run')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--reconnects', type=int, default=5)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--configure-events', type=int, default=2000)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--output', default=None, help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+
+    runs = []
+    for _ in range(args.runs):
+        xvfb = None
+        display = args.display
+        if args.xvfb:
+            xvfb, display = start_xvfb()
+        try:
+            runs.append(run_benchmark(
+                display,
+                reconnects=args.reconnects,
+                api_latency=args.api_latency,
+                configure_events=args.configure_events,
+                timeout=args.timeout
+            ))
+        finally:
+            if xvfb is not None:
+                xvfb.terminate()
+                xvfb.wait()
+
+    report = {
+        'parameters': {
+            'runs': args.runs,
+            'reconnects': args.reconnects,
+            'api_latency_s': args.api_latency,
+            'configure_events': args.configure_events,
+        },
+        'time_to_first_mapped_window_ms': _summary([r['time_to_first_mapped_window_ms'] for r in runs]),
+        'reconnect_ms': _summary([r['reconnect_ms']['median'] for r in runs if r['reconnect_ms']['samples']]),
+        'configure_requests_per_second': _summary([r['configure_requests_per_second'] for r in runs]),
+        'runs': runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Path: cluster_index.py
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from proxmox_desktop.timeline import span
+
+__all__ = ['VmLocation', 'ClusterResourceIndex']
+
+
+class VmLocation(NamedTuple):
+    vmid: int
+    node: str
+    status: str
+
+
+class ClusterResourceIndex:
+    """
+    vmid -> (node, status) index of the QEMU guests of the whole cluster, built from a single
+    `cluster/resources?type=vm` call and kept for `ttl` seconds.
+    A lookup that misses, or finds the VM not running, refreshes the index once before answering.
+    """
+
+    def __init__(self, fetch: Callable[[], List[Dict[str, Any]]], ttl: float = 10.0):
+        """
+        :param fetch: returns the result of `cluster/resources?type=vm`
+        """
+        self._fetch = fetch
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index: Dict[int, VmLocation] = {}
+        self._refreshed_at: Optional[float] = None
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        start = time.monotonic()
+        with span("cluster/resources"):
+            resources = self._fetch()
+        self._index = {
+            int(r['vmid']): VmLocation(int(r['vmid']), r['node'], r.get('status', 'unknown'))
+            for r in resources
+            if r.get('type') == 'qemu'
+        }
+        self._refreshed_at = time.monotonic()
+        logging.info(
+            f"cluster resource index: {len(self._index)} VMs in {(self._refreshed_at - start) * 1000:.1f} ms"
+        )
+
+    def _stale(self) -> bool:
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.ttl
+
+    def lookup(self, vmid: int) -> Optional[VmLocation]:
+        with self._lock:
+            fresh = self._stale()
+            if fresh:
+                self._refresh()
+            location = self._index.get(vmid)
+            if not fresh and (location is None or location.status != 'running'):
+                self._refresh()
+                location = self._index.get(vmid)
+            return location
+
+    def first_running(self, node: Optional[str] = None) -> Optional[VmLocation]:
+        with self._lock:
+            if self._stale():
+                self._refresh()
+            for location in sorted(self._index.values()):
+                if location.status == 'running' and (node is None or location.node == node):
+                    return location
+            return None
+
+    def invalidate(self):
+        with self._lock:
+            self._refreshed_at = None
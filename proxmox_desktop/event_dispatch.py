@@ -0,0 +1,80 @@
+# Path: event_dispatch.py
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+__all__ = ['EventStats', 'EventDispatcher']
+
+
+class EventStats:
+    __slots__ = ('name', 'count', 'total_time', 'max_time')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+
+class EventDispatcher:
+    """
+    Maps every X event class to its handler, so that an event costs a single dict lookup.
+    Each entry keeps the number of events handled and the time spent in the handler.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[type, Tuple[Callable[[Any], None], EventStats]] = {}
+        self._unhandled: Dict[type, EventStats] = {}
+        self._started_at = time.monotonic()
+
+    def register(self, event_type: type, handler: Callable[[Any], None]):
+        self._handlers[event_type] = (handler, EventStats(event_type.__name__))
+
+    def dispatch(self, event: Any) -> bool:
+        """
+        Run the handler registered for the type of `event`.
+        :return: False if no handler is registered for the event type
+        """
+        entry = self._handlers.get(type(event))
+        if entry is None:
+            event_type = type(event)
+            stats = self._unhandled.get(event_type)
+            if stats is None:
+                stats = self._unhandled[event_type] = EventStats(event_type.__name__)
+            stats.add(0.0)
+            return False
+        handler, stats = entry
+        start = time.perf_counter()
+        try:
+            handler(event)
+        finally:
+            stats.add(time.perf_counter() - start)
+        return True
+
+    def stats(self) -> List[EventStats]:
+        """
+        :return: the stats of every event type seen so far, most frequent first
+        """
+        all_stats = [stats for _, stats in self._handlers.values() if stats.count]
+        all_stats.extend(self._unhandled.values())
+        return sorted(all_stats, key=lambda s: s.count, reverse=True)
+
+    def format_stats(self, now: Optional[float] = None) -> str:
+        if now is None:
+            now = time.monotonic()
+        uptime = max(now - self._started_at, 1e-9)
+        lines = [
+            f"{'event':<28} {'count':>10} {'per sec':>10} {'total ms':>12} {'avg us':>10} {'max us':>10}"
+        ]
+        for s in self.stats():
+            avg = s.total_time / s.count if s.count else 0.0
+            lines.append(
+                f"{s.name:<28} {s.count:>10} {s.count / uptime:>10.2f} {s.total_time * 1000:>12.3f} "
+                f"{avg * 1e6:>10.1f} {s.max_time * 1e6:>10.1f}"
+            )
+        return "\n".join(lines)
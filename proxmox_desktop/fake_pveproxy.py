@@ -0,0 +1,239 @@
+# Path: fake_pveproxy.py
+"""
+Local stand-in for pveproxy over HTTPS (self-signed certificate), and a check of the https backend
+of ProxmoxViewer against it: keep-alive session, ticket cache reuse across instances, re-login on a
+rejected ticket.
+
+    python -m proxmox_desktop.fake_pveproxy
+
+Needs the openssl command to create the certificate. Prints a JSON report; exits with 1 if a check fails.
+"""
+import argparse
+import http.server
+import json
+import logging
+import secrets
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from proxmox_desktop.proxmox_viewer import ProxmoxViewer
+
+__all__ = ['FakePveproxy', 'check_https_backend', 'main']
+
+
+def _self_signed_cert(directory: str) -> Tuple[str, str]:
+    cert, key = f"{directory}/cert.pem", f"{directory}/key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", key, "-out", cert],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return cert, key
+
+
+class FakePveproxy:
+    """
+    HTTPS server answering /access/ticket logins and, for a valid PVEAuthCookie (and CSRFPreventionToken
+    on writes), cluster/resources and spiceproxy of the VMs given. Counts logins, TLS connections and
+    rejected requests.
+    """
+
+    def __init__(self, vms: Dict[int, str], cert: str, key: str, user: str = "bench@pam", password: str = "bench"):
+        self.vms = dict(vms)
+        self.user = user
+        self.password = password
+        self.stats: Counter = Counter()
+        # ticket -> CSRF token
+        self._tickets: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep-alive
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake._handle(self, 'GET')
+
+            def do_POST(self):
+                fake._handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            daemon_threads = True
+
+            def get_request(self):
+                sock, address = super().get_request()
+                with fake._lock:
+                    fake.stats['connections'] += 1
+                return sock, address
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-pveproxy", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def revoke_tickets(self):
+        """
+        Forget every ticket issued, as a pveproxy whose auth key was rotated.
+        """
+        with self._lock:
+            self._tickets.clear()
+
+    def _handle(self, request: http.server.BaseHTTPRequestHandler, method: str):
+        url = urllib.parse.urlsplit(request.path)
+        path = tuple(p for p in url.path.split('/') if p)
+        length = int(request.headers.get('Content-Length') or 0)
+        params = dict(urllib.parse.parse_qsl(request.rfile.read(length).decode())) if length else {}
+        params.update(urllib.parse.parse_qsl(url.query))
+        if path[:2] != ('api2', 'json'):
+            self._reply(request, 404, None)
+            return
+        path = path[2:]
+        if path == ('access', 'ticket') and method == 'POST':
+            self._reply(request, 200, self._login(params))
+            return
+        with self._lock:
+            csrf_token = self._tickets.get(self._cookie(request))
+            authorized = csrf_token is not None and (
+                method == 'GET' or request.headers.get('CSRFPreventionToken') == csrf_token
+            )
+            self.stats['requests' if authorized else 'rejected'] += 1
+        if not authorized:
+            self._reply(request, 401, None)
+            return
+        data = self._answer(method, path, params)
+        self._reply(request, 200 if data is not None else 501, data)
+
+    @staticmethod
+    def _cookie(request: http.server.BaseHTTPRequestHandler) -> Optional[str]:
+        for cookie in (request.headers.get('Cookie') or '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == 'PVEAuthCookie':
+                return urllib.parse.unquote(value)
+        return None
+
+    def _login(self, params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        if params.get('username') != self.user or params.get('password') != self.password:
+            return None
+        ticket = f"PVE:{self.user}:{int(time.time()):08X}::{secrets.token_hex(16)}"
+        csrf_token = f"{int(time.time()):08X}:{secrets.token_hex(16)}"
+        with self._lock:
+            self.stats['logins'] += 1
+            self._tickets[ticket] = csrf_token
+        return {'ticket': ticket, 'CSRFPreventionToken': csrf_token, 'username': self.user}
+
+    def _answer(self, method: str, path: Tuple[str, ...], params: Dict[str, str]) -> Any:
+        if path == ('cluster', 'resources') and method == 'GET':
+            return [
+                {'type': 'qemu', 'id': f"qemu/{vmid}", 'vmid': vmid, 'node': node, 'status': 'running'}
+                for vmid, node in self.vms.items()
+            ]
+        if len(path) == 5 and path[0] == 'nodes' and path[2] == 'qemu' and path[4] == 'spiceproxy' \
+                and method == 'POST' and self.vms.get(int(path[3])) == path[1]:
+            return {'type': 'spice', 'host': f"pvespiceproxy:{path[3]}", 'password': 'bench', 'tls-port': 61000}
+        return None
+
+    @staticmethod
+    def _reply(request: http.server.BaseHTTPRequestHandler, code: int, data: Any):
+        body = json.dumps({'data': data}).encode()
+        request.send_response(code)
+        request.send_header('Content-Type', 'application/json;charset=UTF-8')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def check_https_backend(vmid: int = 101, calls: int = 5) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    :return: the report and the failed checks
+    """
+    failures = []
+
+    def expect(name: str, condition: bool):
+        if not condition:
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory(prefix="proxmox-desktop-pveproxy-") as tmpdir:
+        cert, key = _self_signed_cert(tmpdir)
+        server = FakePveproxy({vmid: 'node1'}, cert, key)
+        server.start()
+
+        def viewer() -> ProxmoxViewer:
+            return ProxmoxViewer(host="127.0.0.1", port=server.port, backend='https', user=server.user,
+                                 password=server.password, verify_ssl=cert, ticket_cache_dir=f"{tmpdir}/tickets")
+
+        def session(v: ProxmoxViewer):
+            location = v.prepare(vmid).result()
+            for _ in range(calls):
+                v._fetch_spice_ticket(location)
+
+        try:
+            # first start: password login (proxmoxer posts it outside of the session), then a single
+            # keep-alive connection for every call
+            session(viewer())
+            first = dict(server.stats)
+            expect("first start logs in once", first.get('logins') == 1)
+            expect("first start: one keep-alive connection", first.get('connections') == 2)
+
+            # restart: the cached ticket is used without a login, writes included (CSRF token)
+            session(viewer())
+            restart = dict(server.stats)
+            expect("restart skips the login", restart.get('logins') == 1)
+            expect("restart requests accepted", restart.get('rejected', 0) == 0)
+            expect("restart: one keep-alive connection", restart.get('connections') == first.get('connections', 0) + 1)
+
+            # the server forgets the ticket: one rejected call, then a password login
+            server.revoke_tickets()
+            session(viewer())
+            revoked = dict(server.stats)
+            expect("revoked ticket: logs in again", revoked.get('logins') == 2)
+            expect("revoked ticket: a single rejected call", revoked.get('rejected') == 1)
+        finally:
+            server.stop()
+
+    report = {
+        'after_first_start': first,
+        'after_restart': restart,
+        'after_revoked_ticket': revoked,
+        'failed': failures,
+    }
+    return report, failures
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='proxmox-desktop-fake-pveproxy', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=int, default=5, help='SPICE tickets fetched by every instance')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+
+    report, failures = check_https_backend(calls=args.calls)
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Path: log.py
+import atexit
+import io
+import logging
+import logging.handlers
+import pprint
+import queue
+from typing import Any, Optional
+
+from systemd.journal import JournalHandler
+
+__all__ = ['setup_logging', 'LazyPformat']
+
+_LOG_FORMAT = '%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class LazyPformat:
+    """
+    Defers `pprint.pformat` to the moment the log record is actually formatted,
+    so that disabled log levels never pay for it.
+    """
+    __slots__ = ('_obj',)
+
+    _pp = pprint.PrettyPrinter(indent=4)
+
+    def __init__(self, obj: Any):
+        self._obj = obj
+
+    def __str__(self) -> str:
+        return self._pp.pformat(self._obj)
+
+
+def setup_logging(log_level: int, log_file: str) -> logging.handlers.QueueListener:
+    """
+    Configure the root logger to put records on a queue; the journal, file and stream handlers
+    run on the background thread of a QueueListener, so callers never wait for the sinks.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    formatter = logging.Formatter(_LOG_FORMAT)
+    handlers = [
+        JournalHandler(SYSLOG_IDENTIFIER='proxmox-desktop'),
+        logging.FileHandler(filename=log_file, encoding=io.text_encoding('utf-8'), mode='w'),
+        logging.StreamHandler()
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(
+        level=log_level,
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+        force=True
+    )
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def _stop_listener():
+    # flush what is still queued before the interpreter exits
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
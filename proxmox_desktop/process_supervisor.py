@@ -0,0 +1,438 @@
+# Path: process_supervisor.py
+import collections
+import heapq
+import logging
+import os
+import re
+import selectors
+import signal
+import subprocess
+import threading
+import time
+from typing import Deque, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from proxmox_desktop.backoff import Backoff
+
+__all__ = ['OutputBuffer', 'SupervisedProcess', 'ProcessSupervisor', 'log_child_output']
+
+_READ_SIZE = 64 * 1024
+# longer lines are cut, so that a single line cannot flush the buffer
+_MAX_LINE = 4096
+# lines of the buffer logged along with a non-zero exit code
+_EXIT_TAIL_LINES = 5
+
+# every output line of the children, at DEBUG; off unless `log_child_output` turns it on, since DEBUG
+# is the usual level of the root logger
+_output_log = logging.getLogger('proxmox_desktop.child_output')
+_output_log.setLevel(logging.INFO)
+
+
+def log_child_output(enabled: bool):
+    """
+    Log every output line of the child processes, besides keeping them in their buffers.
+    """
+    _output_log.setLevel(logging.DEBUG if enabled else logging.INFO)
+
+
+class OutputBuffer:
+    """
+    The last `size` bytes of output of a process, as whole lines.
+    Filled by the supervisor thread, read by any thread.
+    """
+
+    def __init__(self, size: int = 256 * 1024):
+        self.size = size
+        self._lines: Deque[bytes] = collections.deque()
+        self._bytes = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def append(self, line: bytes):
+        if len(line) > _MAX_LINE:
+            line = line[:_MAX_LINE] + b"..."
+        with self._lock:
+            self._lines.append(line)
+            self._bytes += len(line) + 1
+            while self._bytes > self.size:
+                self._bytes -= len(self._lines.popleft()) + 1
+                self._dropped += 1
+
+    @property
+    def dropped(self) -> int:
+        with self._lock:
+            return self._dropped
+
+    def tail(self, count: int) -> List[bytes]:
+        with self._lock:
+            return list(self._lines)[-count:]
+
+    def getvalue(self) -> bytes:
+        with self._lock:
+            lines = list(self._lines)
+        return b"".join(line + b"\n" for line in lines)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._bytes
+
+
+class SupervisedProcess:
+    """
+    A child process whose output is read by a ProcessSupervisor.
+    Output lines go to an OutputBuffer, and are only logged one by one if `log_child_output` is on;
+    at `log_level` a summary is logged at most every `summary_interval` seconds. The buffer is written to a file by `dump`.
+    """
+
+    def __init__(self, name: str, args: List[str], restart: bool = False, pass_fds: Sequence[int] = (),
+                 log_level: int = logging.INFO, env: Optional[Mapping[str, str]] = None,
+                 buffer_size: int = 256 * 1024, summary_interval: float = 60.0):
+        self.name = name
+        self.args = args
+        self.env = env
+        self.restart = restart
+        self.pass_fds = tuple(pass_fds)
+        self.log_level = log_level
+        self.summary_interval = summary_interval
+        self.process: Optional[subprocess.Popen] = None
+        self.backoff = Backoff(name)
+        self.started_at = 0.0
+        self.lines = 0
+        self.output = OutputBuffer(buffer_size)
+        self._partial = b""
+        # lines and bytes since the last summary
+        self._summary_lines = 0
+        self._summary_bytes = 0
+        self._summary_at = 0.0
+        self.exited = threading.Event()
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return None if self.process is None else self.process.returncode
+
+    def spawn(self):
+        logging.info(f"exec '{self.name}': {self.args}")
+        self._partial = b""
+        self.exited.clear()
+        self.process = subprocess.Popen(
+            self.args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, pass_fds=self.pass_fds, env=self.env)
+        self.started_at = self._summary_at = time.monotonic()
+        self.output.append(f"--- exec {self.args} pid {self.process.pid}".encode())
+        # the fds are only meant for the first run
+        self.pass_fds = ()
+
+    def feed(self, data: bytes):
+        """
+        Split `data` into lines, keeping an incomplete last line for the next chunk.
+        """
+        data = self._partial + data
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        debug = _output_log.isEnabledFor(logging.DEBUG)
+        for line in lines:
+            self.output.append(line)
+            if debug:
+                _output_log.debug("%s: %r", self.name, line)
+        self.lines += len(lines)
+        self._summary_lines += len(lines)
+        self._summary_bytes += len(data) - len(self._partial)
+        if time.monotonic() - self._summary_at >= self.summary_interval:
+            self.log_summary()
+
+    def log_summary(self):
+        """
+        Log the amount of output since the last summary, with its last line.
+        """
+        now = time.monotonic()
+        if self._summary_lines:
+            last = self.output.tail(1)
+            logging.log(
+                self.log_level, "%s: %d lines (%d bytes) of output in %.1f s, last: %r",
+                self.name, self._summary_lines, self._summary_bytes, now - self._summary_at, last[0] if last else b""
+            )
+        self._summary_lines = self._summary_bytes = 0
+        self._summary_at = now
+
+    def finish_output(self):
+        if self._partial:
+            self.feed(b"\n")
+        self.log_summary()
+
+    def dump(self, directory: str, reason: str, prefix: str = "") -> Optional[str]:
+        """
+        Write the output buffer to `directory`, replacing the previous dump of the same process name:
+        a crash loop keeps a single file per process.
+        :return: the path of the file, None if it could not be written
+        """
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", prefix + self.name)
+        path = os.path.join(directory, f"{name}.log")
+        pid = self.process.pid if self.process is not None else 0
+        header = f"# {time.strftime('%Y-%m-%d %H:%M:%S')} {self.name} pid {pid} {self.args}: {reason}"
+        if self.output.dropped:
+            header += f", {self.output.dropped} earlier lines dropped"
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(header.encode() + b"\n")
+                f.write(self.output.getvalue())
+            os.replace(tmp, path)
+        except OSError as e:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            logging.warning(f"cannot write the output of {self.name} to {path}: {e}")
+            return None
+        logging.warning(f"{reason}: output of {self.name} written to {path}")
+        return path
+
+
+class ProcessSupervisor(threading.Thread):
+    """
+    Reads the output of every child process from a single thread, with a selector over their pipes.
+    Processes started with `restart` are started again when they exit, after the delay given by
+    their Backoff; the other ones are dropped from the registry as soon as they exit.
+    The output buffer of a process exiting with a non-zero code is written to `output_dir`.
+    After `terminate_all` the thread ends with the last process, closing its selector and wakeup pipe.
+    """
+
+    def __init__(self, output_dir: Optional[str] = None, buffer_size: int = 256 * 1024,
+                 summary_interval: float = 60.0, label: str = ""):
+        """
+        :param output_dir: where output buffers are written; None to only log their last lines
+        :param label: prefix of the dump file names, to tell apart the supervisors sharing `output_dir`
+        :param buffer_size: bytes of output kept per process
+        :param summary_interval: seconds between two output summaries of a process
+        """
+        super().__init__(name="process-supervisor", daemon=True)
+        self.output_dir = output_dir
+        self.buffer_size = buffer_size
+        self.summary_interval = summary_interval
+        self.label = label
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._new: List[SupervisedProcess] = []
+        # processes whose output is closed but that are still running
+        self._exiting: List[SupervisedProcess] = []
+        self._processes: Dict[int, SupervisedProcess] = {}
+        # (due time, sequence, process) of the processes waiting to be restarted
+        self._scheduled: List[Tuple[float, int, SupervisedProcess]] = []
+        self._sequence = 0
+        self._stopping = False
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def spawn(self, name: str, args: List[str], restart: bool = False, pass_fds: Sequence[int] = (),
+              log_level: int = logging.INFO, env: Optional[Mapping[str, str]] = None) -> SupervisedProcess:
+        """
+        Start a process. It is spawned before returning, so that the caller can close the `pass_fds`.
+        """
+        proc = SupervisedProcess(name, args, restart=restart, pass_fds=pass_fds, log_level=log_level, env=env,
+                                 buffer_size=self.buffer_size, summary_interval=self.summary_interval)
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError(f"cannot start {name}: the process supervisor is stopped")
+        proc.spawn()
+        with self._lock:
+            stopped = self._stopping
+            if not stopped:
+                self._new.append(proc)
+                if not self.is_alive():
+                    self.start()
+        if stopped:
+            self._discard(proc)
+            raise RuntimeError(f"cannot start {name}: the process supervisor is stopped")
+        self._wakeup()
+        return proc
+
+    def processes(self) -> List[SupervisedProcess]:
+        """
+        :return: the processes that are running or waiting to be restarted
+        """
+        with self._lock:
+            return list(self._processes.values()) + self._exiting + self._new + [p for _, _, p in self._scheduled]
+
+    def dump_all(self, reason: str):
+        """
+        Write the output buffer of every process still registered, e.g. when the seat they belong to failed.
+        Processes already gone were dumped when they exited, if they failed.
+        """
+        for proc in self.processes():
+            self._dump(proc, reason)
+
+    def _dump(self, proc: SupervisedProcess, reason: str):
+        for line in proc.output.tail(_EXIT_TAIL_LINES):
+            logging.warning("%s: %r", proc.name, line)
+        if self.output_dir is not None:
+            proc.dump(self.output_dir, reason, prefix=f"{self.label}-" if self.label else "")
+
+    def terminate_all(self, timeout: float = 30):
+        """
+        Stop restarting processes, then terminate the running ones, killing those still alive after `timeout`.
+        """
+        with self._lock:
+            self._stopping = True
+            self._scheduled.clear()
+            started = self.ident is not None
+        if started:
+            # the loop checks whether it is done
+            self._wakeup()
+        else:
+            self._close()
+        running = [p.process for p in self.processes() if p.process is not None and p.process.poll() is None]
+        for process in running:
+            logging.info(f"terminating {process.args}")
+            try:
+                process.terminate()
+            except Exception as e:
+                logging.exception(e)
+        deadline = time.monotonic() + timeout
+        for process in running:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.info(f"killing {process.args}")
+                os.kill(process.pid, signal.SIGKILL)
+            except Exception as e:
+                logging.exception(e)
+
+    def _wakeup(self):
+        with self._lock:
+            if self._wakeup_w is None:
+                return
+            try:
+                os.write(self._wakeup_w, b"\0")
+            except BlockingIOError:
+                # a wakeup is already pending
+                pass
+
+    def _close(self):
+        with self._lock:
+            if self._wakeup_w is None:
+                return
+            self._selector.close()
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+
+    def _done(self) -> bool:
+        with self._lock:
+            return self._stopping and not (self._processes or self._exiting or self._new)
+
+    def _register_new(self):
+        with self._lock:
+            new, self._new = self._new, []
+            for proc in new:
+                fd = proc.process.stdout.fileno()
+                self._processes[fd] = proc
+                self._selector.register(fd, selectors.EVENT_READ, proc)
+
+    def run(self):
+        try:
+            while True:
+                self._register_new()
+                self._restart_due()
+                if self._done():
+                    return
+                for key, _ in self._selector.select(self._select_timeout()):
+                    if key.data is None:
+                        os.read(self._wakeup_r, 4096)
+                        continue
+                    self._read(key.fd, key.data)
+                self._reap()
+        finally:
+            self._close()
+
+    def _read(self, fd: int, proc: SupervisedProcess):
+        try:
+            data = os.read(fd, _READ_SIZE)
+        except OSError as e:
+            logging.warning(f"{proc.name}: read error {e}")
+            data = b""
+        if data:
+            proc.feed(data)
+            return
+        # EOF: the process closed its output
+        self._selector.unregister(fd)
+        proc.process.stdout.close()
+        proc.finish_output()
+        with self._lock:
+            del self._processes[fd]
+            self._exiting.append(proc)
+
+    def _reap(self):
+        if not self._exiting:
+            return
+        still_running = []
+        for proc in self._exiting:
+            exitcode = proc.process.poll()
+            if exitcode is None:
+                still_running.append(proc)
+                continue
+            logging.info(f"{proc.name} exit code: {exitcode}")
+            # terminated by terminate_all: an expected exit
+            if exitcode != 0 and not self._stopping:
+                self._dump(proc, f"{proc.name} exited with code {exitcode}")
+            proc.exited.set()
+            if proc.restart:
+                self._schedule_restart(proc)
+        with self._lock:
+            self._exiting = still_running
+
+    def _schedule_restart(self, proc: SupervisedProcess):
+        delay = proc.backoff.next_delay(time.monotonic() - proc.started_at)
+        logging.info(f"restarting {proc.name} in {delay:.1f} seconds")
+        with self._lock:
+            if self._stopping:
+                return
+            self._sequence += 1
+            heapq.heappush(self._scheduled, (time.monotonic() + delay, self._sequence, proc))
+
+    def _restart_due(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._scheduled or self._scheduled[0][0] > now or self._stopping:
+                    return
+                _, _, proc = heapq.heappop(self._scheduled)
+            try:
+                proc.spawn()
+            except Exception as e:
+                logging.exception(e)
+                self._schedule_restart(proc)
+                continue
+            with self._lock:
+                stopped = self._stopping
+                if not stopped:
+                    self._new.append(proc)
+            if stopped:
+                self._discard(proc)
+                return
+            self._register_new()
+
+    @staticmethod
+    def _discard(proc: SupervisedProcess):
+        """
+        Terminate a process spawned while `terminate_all` was running, which could not see it.
+        """
+        logging.info(f"terminating {proc.args}")
+        try:
+            proc.process.terminate()
+            proc.process.wait(5)
+        except subprocess.TimeoutExpired:
+            logging.info(f"killing {proc.args}")
+            proc.process.kill()
+            proc.process.wait()
+        except Exception as e:
+            logging.exception(e)
+        proc.process.stdout.close()
+        proc.exited.set()
+
+    def _select_timeout(self) -> Optional[float]:
+        if self._exiting:
+            return 0.1
+        with self._lock:
+            if self._scheduled:
+                return max(0.0, self._scheduled[0][0] - time.monotonic())
+        return None
@@ -4,27 +4,35 @@
 # https://monroeclinton.com/build-your-own-window-manager/
 # https://docs.qtile.org/en/0.10.5/_modules/libqtile/manager.html
 
-import io
+import fcntl
 import logging
 import os
 import pprint
-from signal import Signals
+from functools import partial
+import select
+import signal
+import socket
 import subprocess
 import threading
 import time
 from pathlib import Path
 from threading import Thread
-from typing import Any, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import Xlib.display
-import Xlib.ext.dpms
-import Xlib.ext.randr
-import Xlib.xobject.drawable
 import xcffib
+import xcffib.dpms
+import xcffib.randr
 import xcffib.xproto
-from systemd.journal import JournalHandler
 
-from proxmox_desktop.proxmox_viewer import ProxmoxViewer
+from proxmox_desktop.atoms import AtomRegistry
+from proxmox_desktop.event_dispatch import EventDispatcher, EventStats
+from proxmox_desktop.log import LazyPformat, setup_logging
+from proxmox_desktop.metrics import REGISTRY, MetricFamily, MetricsServer, TextfileWriter
+from proxmox_desktop.process_supervisor import ProcessSupervisor, SupervisedProcess, log_child_output
+from proxmox_desktop.proxmox_viewer import ProxmoxViewer, parse_prefetch_interval
+from proxmox_desktop.replay import EventRecorder
+from proxmox_desktop.status_view import StatusView
+from proxmox_desktop.timeline import Timeline, activate
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -32,6 +40,61 @@ _NET_WM_STATE_REMOVE = 0
 _NET_WM_STATE_ADD = 1
 _NET_WM_STATE_TOGGLE = 2
 
+# linux/vt.h
+_VT_ACTIVATE = 0x5606
+_VT_WAITACTIVE = 0x5607
+
+_ATOM_NAMES = (
+    "_NET_WM_STATE",
+    "_NET_WM_STATE_MAXIMIZED_VERT",
+    "_NET_WM_STATE_MAXIMIZED_HORZ",
+)
+
+
+Geometry = Tuple[int, int, int, int, int]
+
+_BATCH_SECONDS = REGISTRY.histogram(
+    'x_batch_seconds', 'time from reading a batch of X events to the flush of the requests of its handlers', ('seat',),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+
+class WindowRecord:
+    __slots__ = ('override_redirect', 'geometry', 'managed')
+
+    def __init__(self, override_redirect: bool, geometry: Optional[Geometry] = None):
+        self.override_redirect = override_redirect
+        # x, y, width, height, border width as last known to the server
+        self.geometry = geometry
+        # mapped full screen by us
+        self.managed = False
+
+
+def make_proxmox_viewer(
+        proxmox_host: Optional[str] = None,
+        proxmox_backend: Optional[str] = "local",
+        remote_viewer_path: str = '/usr/bin/remote-viewer',
+        proxmox_user: Optional[str] = None,
+        proxmox_password: Optional[str] = None,
+        proxmox_verify_ssl: Optional[bool] = None,
+        **kwargs) -> ProxmoxViewer:
+    """
+    Build the ProxmoxViewer from the command line / config options; other `proxmox_` options
+    are passed with the prefix stripped, the remaining options are ignored.
+    """
+    proxmox_kwargs = {}
+    for k, v in kwargs.items():
+        if k.startswith('proxmox_'):
+            proxmox_kwargs[k[8:]] = v
+    return ProxmoxViewer(
+        host=proxmox_host,
+        user=proxmox_user,
+        password=proxmox_password,
+        verify_ssl=proxmox_verify_ssl,
+        backend=proxmox_backend,
+        remote_viewer_path=remote_viewer_path,
+        **proxmox_kwargs
+    )
+
 
 class MWM(threading.Thread):
     _screen_rotation: int
@@ -40,10 +103,6 @@ class MWM(threading.Thread):
 
     _vt: int
 
-    _processes: List[subprocess.Popen] = []
-
-    display: Optional[Xlib.display.Display]
-
     conn: Optional[xcffib.Connection]
 
     setup: Optional[xcffib.xproto.Setup]
@@ -52,76 +111,135 @@ class MWM(threading.Thread):
 
     _vmid: int
 
-    _windows: set[int]
+    # managed windows
+    _windows: Dict[int, WindowRecord]
+
+    # window -> last known _NET_WM_STATE atoms
+    _net_wm_state: Dict[int, set[int]]
+
+    # window -> GetProperty(_NET_WM_STATE) cookies not yet replied
+    _net_wm_state_pending: Dict[int, List[Any]]
+
+    # window -> number of PropertyNotify events caused by our own ChangeProperty still to be received
+    _net_wm_state_own_writes: Dict[int, int]
+
+    # work to run once the requests of the current batch have been flushed
+    _deferred: List[Callable[[], None]]
 
     _delta_y = 0
 
     _border = -3
 
+    _poller: Optional[Any] = None
+
+    # status posted from other threads, drawn by the event loop
+    _posted_status: Optional[str] = None
+
+    _randr: Optional[Any] = None
+
+    # geometry every managed window gets, computed once per screen configuration
+    _target_geometry: Geometry
+
+    # window -> last ConfigureRequest of the current batch
+    _pending_configures: Dict[int, xcffib.xproto.ConfigureRequestEvent]
+
+    # seconds to wait for Xorg to accept connections
+    _xserver_timeout = 30
+
+    _xserver_probe_interval = 0.05
+
+    # seconds to wait for the VT switch
+    _chvt_timeout = 2
+
     def __init__(
             self,
             vmid: int,
-            screen_rotation: int = Xlib.ext.randr.Rotate_0,
+            screen_rotation: int = 0,
             display: Optional[str] = None,
             vt: int = 8,
-            log_level: int = logging.DEBUG,
-            log_file: str = "proxmox-desktop.log",
             no_x: bool = False,
-            proxmox_host: Optional[str] = None,
-            proxmox_backend: Optional[str] = "local",
-            remote_viewer_path: str = '/usr/bin/remote-viewer',
-            proxmox_user: Optional[str] = None,
-            proxmox_password: Optional[str] = None,
-            proxmox_verify_ssl: Optional[bool] = None,
+            run_xserver: bool = True,
+            proxmox: Optional[ProxmoxViewer] = None,
+            trace_events: bool = False,
+            external_helpers: bool = False,
+            warm_reconnect: bool = False,
+            reconnect_prefetch: Optional[float] = None,
+            wait_vm: bool = False,
+            start_vm: bool = False,
+            profile_startup: bool = False,
+            startup_trace: Optional[str] = None,
+            record_events: Optional[str] = None,
+            process_output_dir: Optional[str] = None,
+            process_output_buffer: int = 256,
             **kwargs,
     ):
-        super().__init__()
+        """
+        :param run_xserver: start Xorg on `vt`; when False attach to the X server already running on `display`,
+            leaving the VT, screen saver, DPMS and rotation to its owner
+        :param proxmox: shared ProxmoxViewer; when None one is built from the `proxmox_*` options in kwargs
+        :param record_events: write the received X events to this file, for `proxmox_desktop.replay`;
+            {vt} is replaced by the vt
+        :param process_output_dir: where the output of a child process is written when it exits with an error
+            or the seat fails; None to only log its last lines
+        :param process_output_buffer: KiB of output kept in memory per child process
+        """
+        super().__init__(name=f"mwm-tty{vt}")
+        self.conn = None
         self.main_window = None
-        self.root_gc = None
         self.screen = None
         self.gc = None
-        logging.basicConfig(
-            level=log_level,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                JournalHandler(SYSLOG_IDENTIFIER='proxmox-desktop'),
-                logging.FileHandler(filename=log_file, encoding=io.text_encoding('utf-8'), mode='w'),
-                logging.StreamHandler()
-            ],
-            force=True
-        )
+        self._trace_events = trace_events
+        self._native_helpers = not external_helpers
+        # restart the viewer in-process, reusing the VM location, instead of exiting with it
+        self._warm_reconnect = warm_reconnect
+        self._reconnect_prefetch = parse_prefetch_interval(reconnect_prefetch)
+        # wait on the status screen for a VM that is not running (starting it if `start_vm`) instead of exiting
+        self._wait_vm = wait_vm
+        self._start_vm = start_vm
+        # phases of the startup, up to the first MapRequest
+        self._timeline = Timeline(f"tty{vt}")
+        self._profile_startup = profile_startup
+        self._startup_trace = startup_trace.format(vt=vt) if startup_trace else None
+        self._record_events = record_events.format(vt=vt) if record_events else None
+        self._recorder: Optional[EventRecorder] = None
         self._screen_rotation = screen_rotation
         self._display = display
         self._vt = vt
         self._no_x = no_x
-        self._windows = set()
+        self._run_xserver = run_xserver
+        self._windows = {}
+        self._net_wm_state = {}
+        self._net_wm_state_pending = {}
+        self._net_wm_state_own_writes = {}
+        self._deferred = []
+        self._pending_configures = {}
+        self._supervisor = ProcessSupervisor(
+            output_dir=process_output_dir, buffer_size=int(process_output_buffer) * 1024, label=f"tty{vt}"
+        )
+        self._xorg: Optional[SupervisedProcess] = None
+        # why the WM ended, when it was not stopped: an error, or Xorg or the viewer exiting with an error
+        self.failure: Optional[str] = None
+        # set when the WM shuts down: stops the viewer thread
+        self._stopping = threading.Event()
+        # wakes the event loop up for work posted by other threads
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._posted_status_lock = threading.Lock()
+        self._dispatcher = EventDispatcher()
+        self._register_event_handlers()
+        REGISTRY.register_collector(self._collect_metrics)
 
-        proxmox_kwargs = {}
-        for k, v in kwargs.items():
-            if k.startswith('proxmox_'):
-                proxmox_kwargs[k[8:]] = v
         self._vmid = vmid
-        self._proxmox = ProxmoxViewer(
-            host=proxmox_host,
-            user=proxmox_user,
-            password=proxmox_password,
-            verify_ssl=proxmox_verify_ssl,
-            backend=proxmox_backend,
-            remote_viewer_path=remote_viewer_path,
-            **proxmox_kwargs
-        )
+        self._proxmox = proxmox if proxmox is not None else make_proxmox_viewer(**kwargs)
 
     def init(self):
         logging.info("connecting to X server")
-        if self._display:
-            os.putenv("DISPLAY", self._display)
-        logging.info("connecting to X server")
         self.conn = xcffib.connect(display=self._display)
-        self._NET_WM_STATE = self.conn.core.InternAtom(False, len("_NET_WM_STATE"), "_NET_WM_STATE").reply().atom
-        self._NET_WM_STATE_MAXIMIZED_VERT = self.conn.core.InternAtom(True, len("_NET_WM_STATE_MAXIMIZED_VERT"),
-                                                                      "_NET_WM_STATE_MAXIMIZED_VERT").reply().atom
-        self._NET_WM_STATE_MAXIMIZED_VERT = self.conn.core.InternAtom(True, len("_NET_WM_STATE_MAXIMIZED_HORZ"),
-                                                                      "_NET_WM_STATE_MAXIMIZED_HORZ").reply().atom
+        self.atoms = AtomRegistry(self.conn, _ATOM_NAMES)
+        self._NET_WM_STATE = self.atoms["_NET_WM_STATE"]
+        self._NET_WM_STATE_MAXIMIZED_VERT = self.atoms["_NET_WM_STATE_MAXIMIZED_VERT"]
+        self._NET_WM_STATE_MAXIMIZED_HORZ = self.atoms["_NET_WM_STATE_MAXIMIZED_HORZ"]
         self.setup = self.conn.get_setup()
         logging.info(f"connection: {pp.pformat(self.conn)}")
         for i, s in enumerate(self.conn.get_screen_pointers()):
@@ -133,16 +251,10 @@ class MWM(threading.Thread):
         #        f"setup.roots {i}: root {s.root} width_in_pixels {s.width_in_pixels} height_in_pixels {s.height_in_pixels}"
         #    )
 
-        self.display: Xlib.display.Display = Xlib.display.Display(self._display)
-        logging.info(
-            f"display: {pp.pformat(self.display)} {self.display.get_display_name()}"
-        )
-        # for i, s in enumerate(self.display.display.info.roots):
-        #    logging.info(
-        #        f"display.display.info.roots {i}: root {s.root} width_in_pixels {s.width_in_pixels} height_in_pixels {s.height_in_pixels}"
-        #    )
         self.screen = self.conn.get_screen_pointers()[0]
-        # self.screen = self.display.screen()
+        self._screen_width = self.screen.width_in_pixels
+        self._screen_height = self.screen.height_in_pixels
+        self._update_target_geometry()
         logging.info(f"screen: {pp.pformat(self.screen)}")
         logging.info(
             f"screen size: {self.screen.width_in_pixels}, {self.screen.height_in_pixels}"
@@ -181,44 +293,81 @@ class MWM(threading.Thread):
             )
             cookie.check()
 
-            screen = self.display.screen()
-            self.root_gc = screen.root.create_gc(
-                foreground=screen.black_pixel,
-                background=screen.white_pixel,
-            )
-
-            self.main_window = screen.root.create_window(
-                x=0, y=0,
-                width=self.screen.width_in_pixels,
-                height=self.screen.height_in_pixels,
-                border_width=0,
-                depth=screen.root_depth,
-                background_pixel=screen.white_pixel,
-                event_mask=Xlib.X.ExposureMask | Xlib.X.KeyPressMask,
-            )
-            self.gc = self.main_window.create_gc(
-                foreground=screen.black_pixel,
-                background=screen.white_pixel,
+            # status window, served by the same connection and event loop as the window manager
+            self.main_window = self.conn.generate_id()
+            self.conn.core.CreateWindow(
+                self.screen.root_depth,
+                self.main_window,
+                self.screen.root,
+                0, 0,
+                self.screen.width_in_pixels,
+                self.screen.height_in_pixels,
+                0,
+                xcffib.xproto.WindowClass.InputOutput,
+                self.screen.root_visual,
+                xcffib.xproto.CW.BackPixel | xcffib.xproto.CW.EventMask,
+                [
+                    self.screen.white_pixel,
+                    xcffib.xproto.EventMask.Exposure | xcffib.xproto.EventMask.KeyPress
+                ]
             )
-            self.main_window.map()
+            self._status_view = StatusView(self.conn, self.screen, self.main_window)
+            self.gc = self._status_view.gc
+            self.conn.core.MapWindow(self.main_window)
+
+            if self._has_extension('RANDR'):
+                self._randr = self.conn(xcffib.randr.key)
+                self._randr.QueryVersion(1, 1).reply()
+                # follow screen size changes (rotation, resolution) to keep the target geometry right
+                self._randr.SelectInput(self.screen.root, xcffib.randr.NotifyMask.ScreenChange)
+            self.conn.flush()
 
     def run(self):
         try:
-            self._run()
+            with activate(self._timeline):
+                self._run()
         except Exception as e:
             logging.exception(e)
+            self._fail(repr(e))
+        self._check_xorg_exit()
+        if self.failure is not None and not self._stopping.is_set():
+            # before the processes are terminated with the WM
+            self.dump_process_output(self.failure)
+
+    def _fail(self, reason: str):
+        if self.failure is None:
+            self.failure = reason
+
+    def _check_xorg_exit(self):
+        if self._xorg is None or self._xorg.process is None:
+            return
+        try:
+            # the X connection breaks first: give Xorg a moment to exit
+            exitcode = self._xorg.process.wait(1.0)
+        except subprocess.TimeoutExpired:
+            return
+        if exitcode != 0:
+            self._fail(f"Xorg exited with code {exitcode}")
 
     def _run(self):
-        try:
-            self.chvt()
-        except Exception as e:
-            logging.error("failed to change vt")
-            logging.exception(e)
-        if not self._no_x:
-            self.run_xorg()
-            # TODO: replace with a function that waits for the X server to start
-            time.sleep(3)
-        self.init()
+        # login and VM lookup do not need X: run them while Xorg starts
+        self._proxmox.prepare(self._vmid, timeline=self._timeline)
+        if self._run_xserver:
+            try:
+                with self._timeline.span("chvt"):
+                    self.chvt()
+            except Exception as e:
+                logging.error("failed to change vt")
+                logging.exception(e)
+        if self._run_xserver and not self._no_x:
+            with self._timeline.span("xorg start"):
+                displayfd = self.run_xorg()
+                if not self._wait_for_xserver(displayfd, self._xserver_timeout):
+                    logging.warning(f"X server {self._display} not ready after {self._xserver_timeout} seconds")
+        with self._timeline.span("x init"):
+            self.init()
+        if self._record_events:
+            self._recorder = EventRecorder(self._record_events, self.conn, self.screen.root)
 
         self._write_status("initialization complete. starting apps...")
 
@@ -232,140 +381,222 @@ class MWM(threading.Thread):
 
         self._write_status("connecting ...")
         logging.info("processing events")
-        terminate_event = threading.Event()
-        display_loop = Thread(target=self._display_loop, args=[terminate_event])
-        display_loop.start()
-        while event := self.get_event():
+        while True:
             if isinstance(self._main_proc, Thread) and not self._main_proc.is_alive():
-                terminate_event.set()
                 self._write_status("exiting...")
                 logging.info("main process process is terminated")
-                display_loop.join(5)
-                self.display.close()
                 break
 
-            if isinstance(event, bool):
+            events = self.get_events()
+            if events is None:
+                break
+            self._apply_posted_status()
+            if not events:
                 continue
 
-            try:
-                if hasattr(event, 'window'):
-                    logging.info(f"X event: {pp.pformat(event)} window: {event.window}")
-                else:
-                    logging.info(f"X event: {pp.pformat(event)}")
-                if isinstance(event, xcffib.xproto.CreateNotifyEvent):
-                    logging.info(f"X event: CreateNotifyEvent {event.window}")
-                    self._handle_create_notify_event(event)
-                    self.conn.flush()
-
-                if isinstance(event, xcffib.xproto.ConfigureRequestEvent):
-                    logging.info(f"X event: ConfigureRequestEvent")
-                    self._handle_configure_request_event(event)
-                    self.conn.flush()
-
-                if isinstance(event, xcffib.xproto.MapRequestEvent):
-                    logging.info(f"X event: MapRequestEvent")
-                    self._handle_map_request_event(event)
-                    self.conn.flush()
-
-                if isinstance(event, xcffib.xproto.MappingNotifyEvent):
-                    logging.info(f"X event: MappingNotifyEvent")
-                    self._handle_mapping_notify_event(event)
-                    self.conn.flush()
-
-                if isinstance(event, xcffib.xproto.UnmapNotifyEvent):
-                    logging.info(f"X event: UnmapNotifyEvent")
-                    self._handle_unmap_notify_event(event)
-                    self.conn.flush()
-
-                if isinstance(event, xcffib.xproto.DestroyNotifyEvent):
-                    logging.info(f"X event: DestroyNotifyEvent")
-                    self._handle_destroy_notify_event(event)
-
-                if isinstance(event, xcffib.xproto.LeaveNotifyEvent):
-                    logging.info(f"X event: LeaveNotifyEvent {event.detail}")
-
-                if isinstance(event, xcffib.xproto.KeyPressEvent):
-                    logging.info(
-                        f"X event: KeyPressEvent time: {event.time} root: {event.root} event: {event.event} child: {event.child} root_x: {event.root_x} root_y: {event.root_y} event_x: {event.event_x} event_y: {event.event_y} state: {event.state} keycode: {event.detail} same_screen: {event.same_screen}")
-
-                if isinstance(event, xcffib.xproto.PropertyNotifyEvent):
-                    logging.info(
-                        f"X event: PropertyNotifyEvent window: {event.window} state: {event.state} atom: {event.atom} time: {event.time}"
-                    )
-
-                if isinstance(event, xcffib.xproto.ClientMessageEvent):
-                    self._handle_client_message_event(event)
-
-                if isinstance(event, xcffib.xproto.FocusInEvent):
-                    logging.info(f"X event: FocusInEvent {event.mode}")
-
-                if isinstance(event, xcffib.xproto.FocusOutEvent):
-                    logging.info(f"X event: FocusOutEvent {event.mode}")
-
-                if isinstance(event, xcffib.xproto.ButtonPressEvent):
-                    logging.info(f"X event: ButtonPressEvent {event.detail}")
-
-                if isinstance(event, xcffib.xproto.ButtonReleaseEvent):
-                    logging.info(f"X event: ButtonReleaseEvent {event.detail}")
-
-                if isinstance(event, xcffib.xproto.MotionNotifyEvent):
-                    logging.info(f"X event: MotionNotifyEvent {event.detail}")
-
-                # self.conn.flush()
-            except Exception as e:
-                logging.error(pp.pformat(e))
-                logging.exception(e)
+            received_at = time.monotonic()
+            if self._recorder is not None:
+                self._recorder.write_batch(received_at, events)
+            self.process_events(events)
+            self._record_event_latency(received_at, len(events))
 
             try:
                 self.conn.invalid()
             except:
                 logging.warning("connection invalidated")
                 break
+        self._log_event_latency()
+        self.dump_event_stats()
+        self._close_recorder()
+
+    def process_events(self, events: List[Any]):
+        """
+        Handle a batch of events as received by `get_events`, then send the requests of the handlers.
+        """
+        for event in events:
+            try:
+                self._handle_event(event)
+            except Exception as e:
+                logging.exception(e)
+        self._apply_pending_configures()
+        if self._status_view is not None:
+            self._status_view.flush()
+        # a single flush for the whole batch: every request issued by the handlers goes out together
+        self.conn.flush()
+        self._run_deferred()
+
+    def _close_recorder(self):
+        recorder, self._recorder = getattr(self, '_recorder', None), None
+        if recorder is not None:
+            recorder.close()
+
+    def _register_event_handlers(self):
+        handlers = {
+            xcffib.xproto.CreateNotifyEvent: self._handle_create_notify_event,
+            xcffib.xproto.ConfigureRequestEvent: self._handle_configure_request_event,
+            xcffib.xproto.MapRequestEvent: self._handle_map_request_event,
+            xcffib.xproto.MappingNotifyEvent: self._handle_mapping_notify_event,
+            xcffib.xproto.UnmapNotifyEvent: self._handle_unmap_notify_event,
+            xcffib.xproto.DestroyNotifyEvent: self._handle_destroy_notify_event,
+            xcffib.xproto.LeaveNotifyEvent: self._handle_leave_notify_event,
+            xcffib.xproto.KeyPressEvent: self._handle_key_press_event,
+            xcffib.xproto.PropertyNotifyEvent: self._handle_property_notify_event,
+            xcffib.xproto.ClientMessageEvent: self._handle_client_message_event,
+            xcffib.xproto.FocusInEvent: self._handle_focus_event,
+            xcffib.xproto.FocusOutEvent: self._handle_focus_event,
+            xcffib.xproto.ButtonPressEvent: self._handle_button_event,
+            xcffib.xproto.ButtonReleaseEvent: self._handle_button_event,
+            xcffib.xproto.MotionNotifyEvent: self._handle_motion_notify_event,
+            xcffib.xproto.ExposeEvent: self._handle_expose_event,
+            xcffib.xproto.ConfigureNotifyEvent: self._handle_configure_notify_event,
+            xcffib.randr.ScreenChangeNotifyEvent: self._handle_screen_change_notify_event,
+        }
+        for event_type, handler in handlers.items():
+            self._dispatcher.register(event_type, handler)
+
+    def _handle_event(self, event):
+        if self._trace_events:
+            logging.info("X event: %s", LazyPformat(event))
+        self._dispatcher.dispatch(event)
+
+    def toggle_event_trace(self):
+        self._trace_events = not self._trace_events
+        logging.info("X event trace %s", "enabled" if self._trace_events else "disabled")
 
-    def _display_loop(self, terminate_event: threading.Event):
-        while terminate_event.is_set() is False:
-            e = self.display.next_event()
-            logging.info(f"Xlib display event: {e}")
-            if e.type == Xlib.X.Expose:
-                self.main_window.fill_rectangle(gc=self.gc, x=20, y=20, width=10, height=10)
-                self._write_status()
+    def event_stats(self) -> List[EventStats]:
+        return self._dispatcher.stats()
+
+    def dump_event_stats(self):
+        logging.info(f"X event stats:\n{self._dispatcher.format_stats()}")
+
+    # event latency: time from reading a batch of events off the socket to the flush of the requests
+    # issued by their handlers
+    _latency_count = 0
+    _latency_total = 0.0
+    _latency_max = 0.0
+    _latency_report_every = 1000
+    _latency_next_report = 1000
+
+    def _collect_metrics(self) -> List[MetricFamily]:
+        """
+        Per event type counters of the dispatcher, read at scrape time: rates come from the scraper.
+        """
+        labels = ('seat', 'type')
+        seat = f"tty{self._vt}"
+        stats = self.event_stats()
+        return [
+            MetricFamily('x_events_total', 'counter', 'X events handled, by type',
+                         [(labels, (seat, s.name), s.count) for s in stats]),
+            MetricFamily('x_handler_seconds_total', 'counter', 'time spent in the X event handlers, by type',
+                         [(labels, (seat, s.name), s.total_time) for s in stats]),
+        ]
+
+    def _record_event_latency(self, received_at: float, count: int):
+        latency = time.monotonic() - received_at
+        _BATCH_SECONDS.observe(latency, f"tty{self._vt}")
+        self._latency_count += count
+        self._latency_total += latency * count
+        if latency > self._latency_max:
+            self._latency_max = latency
+        if self._latency_count >= self._latency_next_report:
+            self._latency_next_report = self._latency_count + self._latency_report_every
+            self._log_event_latency()
+
+    def _log_event_latency(self):
+        if not self._latency_count:
+            return
+        logging.info(
+            f"X event latency: {self._latency_count} events, "
+            f"avg {self._latency_total / self._latency_count * 1000:.3f} ms, "
+            f"max {self._latency_max * 1000:.3f} ms"
+        )
+
+    def _handle_expose_event(self, event: xcffib.xproto.ExposeEvent):
+        logging.debug(
+            "X event: ExposeEvent window: %s x: %s y: %s width: %s height: %s count: %s",
+            event.window, event.x, event.y, event.width, event.height, event.count
+        )
+        if event.window != self.main_window:
+            return
+        # the repaint happens once, at the end of the batch
+        self._status_view.damage(event.x, event.y, event.width, event.height)
 
     _status = None
 
+    _status_view: Optional[StatusView] = None
+
+    def post_status(self, msg: str):
+        """
+        `_write_status` for other threads: the message is drawn by the event loop, which is woken up for it.
+        """
+        with self._posted_status_lock:
+            self._posted_status = msg
+        self._wakeup()
+
+    def _apply_posted_status(self):
+        with self._posted_status_lock:
+            msg, self._posted_status = self._posted_status, None
+        if msg is not None:
+            self._write_status(msg)
+
     def _write_status(self, msg: Optional[str] = None):
         if msg is not None:
             self._status = msg
         if self._status is None:
             self._status = "starting..."
-        self.main_window.clear_area(0, 0, self.screen.width_in_pixels, self.screen.height_in_pixels)
-        self.main_window.draw_text(
-            gc=self.gc,
-            x=int(self.screen.width_in_pixels / 2),
-            y=int(self.screen.height_in_pixels / 2),
-            text=self._status
+        if self._status_view is None:
+            return
+        self._status_view.set_text(self._status)
+        self._status_view.flush()
+        self.conn.flush()
+
+    def run_process(self, process_name: str, args: List[str], restart=False, pass_fds=(),
+                    log_level: int = logging.INFO) -> SupervisedProcess:
+        """
+        Start a process whose output is read by the process supervisor thread.
+        The process is spawned before returning, so that the caller can close the fds it passed.
+        :param log_level: level the output summaries are logged at
+        """
+        # DISPLAY goes to the child only: several seats may share this process
+        env = dict(os.environ, DISPLAY=self._display) if self._display else None
+        proc = self._supervisor.spawn(
+            process_name, args, restart=restart, pass_fds=pass_fds, log_level=log_level, env=env
         )
-        self.display.flush()
-
-    def run_process(self, process_name: str, args: List[str], restart=False) -> Thread:
-        thread = Thread(target=self._runprocess, args=[process_name, args, restart])
-        thread.start()
-        return thread
-
-    def _runprocess(self, process_name: str, args: List[str], restart=False):
-        logging.info(f"exec '{process_name}': {args}")
-        process = subprocess.Popen(
-            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        self._processes.append(process)
-        with process.stdout:
-            for line in iter(process.stdout.readline, b''):
-                # logging.info(f"{process_name}: {line.decode('utf-8')}")
-                logging.info(f"{process_name}: %r", line)
-        exitcode = process.wait()
-        logging.info(f"{process_name} exit code: {exitcode}")
-        if restart:  # TODO: check stop signal (??)
-            self._runprocess(process_name=process_name, args=args, restart=restart)
+        return proc
+
+    def dump_process_output(self, reason: str):
+        """
+        Write the buffered output of the child processes, Xorg included, e.g. when the seat failed.
+        """
+        self._supervisor.dump_all(reason)
+
+    def _apply_helper(self, name: str, native: Callable[[], None], external: Callable[[], None]):
+        """
+        Apply a setting over the WM's own X connection (or ioctl), falling back to the external command.
+        """
+        start = time.monotonic()
+        if self._native_helpers:
+            try:
+                native()
+                logging.info(f"{name}: applied in-process in {(time.monotonic() - start) * 1000:.1f} ms")
+                return
+            except Exception as e:
+                logging.warning(f"{name}: in-process call failed ({e!r}), falling back to the external command")
+        external()
+        logging.info(f"{name}: external command spawned in {(time.monotonic() - start) * 1000:.1f} ms")
 
     def run_apps(self):
+        if self._run_xserver:
+            start = time.monotonic()
+            with self._timeline.span("screen setup"):
+                self._setup_screen()
+            logging.info(f"screen setup took {(time.monotonic() - start) * 1000:.1f} ms")
+
+        # main app
+        logging.info("start main app")
+        self.run_viewer()
+
+    def _setup_screen(self):
         # disabilita screensaver
         logging.info("disable screen saver")
         self.screen_saver_disable()
@@ -379,61 +610,189 @@ class MWM(threading.Thread):
         logging.info("rotating screen")
         self.screen_rotate()
 
-        # main app
-        logging.info("start main app")
-        self.run_viewer()
-
     def chvt(self):
         logging.info(f"changing vt to {self._vt}")
-        self.run_process("chvt", ["chvt", str(self._vt)])
+        self._apply_helper(
+            "chvt",
+            self._chvt_ioctl,
+            lambda: self.run_process("chvt", ["chvt", str(self._vt)])
+        )
 
-    def run_xorg(self):
+    def _chvt_ioctl(self):
+        fd = os.open("/dev/tty0", os.O_RDWR | os.O_NOCTTY)
+        try:
+            fcntl.ioctl(fd, _VT_ACTIVATE, self._vt)
+        except Exception:
+            os.close(fd)
+            raise
+        # VT_WAITACTIVE has no timeout: wait for it on a helper thread that owns the fd
+        waiter = Thread(target=self._vt_wait_active, args=[fd], daemon=True)
+        waiter.start()
+        waiter.join(self._chvt_timeout)
+        if waiter.is_alive():
+            logging.warning(f"vt{self._vt} not active after {self._chvt_timeout} seconds")
+
+    def _vt_wait_active(self, fd: int):
+        try:
+            fcntl.ioctl(fd, _VT_WAITACTIVE, self._vt)
+        except OSError as e:
+            logging.warning(f"VT_WAITACTIVE failed: {e}")
+        finally:
+            os.close(fd)
+
+    def run_xorg(self) -> int:
+        """
+        Start Xorg.
+        :return: read end of the pipe Xorg writes the display number to once it accepts connections
+        """
         logging.info("starting Xorg")
-        self.run_process(
-            "Xorg",
-            [
-                "Xorg", self._display,
-                "-nolisten", "tcp",
-                "-keeptty",
-                f"vt{self._vt}",
-                # f"tty{self._vt}",
-                "-verbose", "0",
-                # "-once",
-                "-logfile", "/dev/stdout",
-            ]
-        )
+        displayfd_r, displayfd_w = os.pipe()
+        try:
+            self._xorg = self.run_process(
+                "Xorg",
+                [
+                    "Xorg", self._display,
+                    "-nolisten", "tcp",
+                    "-keeptty",
+                    f"vt{self._vt}",
+                    # f"tty{self._vt}",
+                    "-verbose", "0",
+                    # "-once",
+                    "-logfile", "/dev/stdout",
+                    "-displayfd", str(displayfd_w),
+                ],
+                pass_fds=(displayfd_w,)
+            )
+        finally:
+            # only Xorg must hold the write end, so that its exit shows up as EOF
+            os.close(displayfd_w)
+        return displayfd_r
+
+    def _wait_for_xserver(self, displayfd: Optional[int], timeout: float) -> bool:
+        """
+        :raise RuntimeError: Xorg exited before accepting connections
+        """
+        deadline = time.monotonic() + timeout
+        if displayfd is not None:
+            try:
+                if self._wait_displayfd(displayfd, deadline):
+                    return True
+            finally:
+                os.close(displayfd)
+        # no notification from the server: probe its socket until the deadline
+        return self._probe_xserver_socket(deadline)
+
+    def _check_xorg_running(self, timeout: float = 0.0):
+        """
+        :param timeout: seconds to wait for Xorg to exit
+        :raise RuntimeError: Xorg has exited, with its exit code and last output lines
+        """
+        if self._xorg is None or self._xorg.process is None:
+            return
+        try:
+            exitcode = self._xorg.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            return
+        output = "\n".join(line.decode(errors='replace') for line in self._xorg.output.tail(10))
+        raise RuntimeError(f"Xorg exited with code {exitcode} before accepting connections:\n{output}")
+
+    def _wait_displayfd(self, displayfd: int, deadline: float) -> bool:
+        data = b""
+        while (remaining := deadline - time.monotonic()) > 0:
+            readable, _, _ = select.select([displayfd], [], [], remaining)
+            if not readable:
+                break
+            chunk = os.read(displayfd, 64)
+            if not chunk:
+                # Xorg died, or did not take -displayfd
+                self._check_xorg_running(timeout=min(1.0, max(0.0, deadline - time.monotonic())))
+                logging.warning("X server closed -displayfd without reporting a display")
+                return False
+            data += chunk
+            if b"\n" in data:
+                logging.info(f"X server ready on display :{data.decode().strip()}")
+                return True
+        return False
+
+    def _probe_xserver_socket(self, deadline: float) -> bool:
+        if not self._display or not self._display.startswith(':'):
+            # not a local display, nothing to probe
+            return True
+        path = f"/tmp/.X11-unix/X{self._display[1:].split('.')[0]}"
+        while True:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(path)
+                    logging.info(f"X server accepting connections on {path}")
+                    return True
+                except OSError:
+                    pass
+            self._check_xorg_running()
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self._xserver_probe_interval)
 
     def disable_screen_standby(self):
-        self.run_process("xset", ["xset", "s", "off", "-dpms"])
+        def native():
+            self.screen_saver_disable()
+            self.dpms_disable()
+
+        self._apply_helper(
+            "xset s off -dpms",
+            native,
+            lambda: self.run_process("xset", ["xset", "s", "off", "-dpms"])
+        )
 
     def run_viewer(self):
         if self._screen_rotation in [0, 2]:
-            windows_size = f"{self.screen.height_in_pixels},{self.screen.width_in_pixels}"
+            windows_size = f"{self._screen_height},{self._screen_width}"
         else:
-            windows_size = f"{self.screen.width_in_pixels},{self.screen.height_in_pixels}"
+            windows_size = f"{self._screen_width},{self._screen_height}"
         logging.info(f"windows size: {windows_size}")
         self._main_proc = Thread(
-            target=self._proxmox.remote_viewer,
-            args=[
-                self._vmid,
-                None,
-                [
+            target=self._run_viewer,
+            name=f"viewer-tty{self._vt}",
+            kwargs=dict(
+                vmid=self._vmid,
+                node=None,
+                args=[
                     '--full-screen',
                     # '--spice-debug', '--debug',
                     '--kiosk', '--kiosk-quit=on-disconnect',
                     f'--display={self._display}',
                 ],
-                False
-            ]
+                restart=self._warm_reconnect,
+                warm=self._warm_reconnect,
+                prefetch_interval=self._reconnect_prefetch,
+                stop=self._stopping,
+                wait_running=self._wait_vm,
+                auto_start=self._start_vm,
+                status=self.post_status,
+                timeline=self._timeline,
+            )
         )
         self._main_proc.start()
 
+    def _run_viewer(self, **kwargs):
+        try:
+            exitcode = self._proxmox.remote_viewer(**kwargs)
+        except Exception as e:
+            logging.exception(e)
+            self._fail(f"viewer failed: {e!r}")
+            return
+        if exitcode:
+            self._fail(f"remote-viewer exited with code {exitcode}")
+
     def configure_screensaver(self):
-        self.run_process("xset", ["xset", "s", "600"])
+        self._apply_helper(
+            "xset s 600",
+            lambda: self.set_screen_saver_timeout(600),
+            lambda: self.run_process("xset", ["xset", "s", "600"])
+        )
         # self.run_process("xss-lock", ["xss-lock", "--", "<command to execute as screensaver>"])
 
     def screen_rotate(self):
-        self.screen_rotate_xrandr()
+        self._apply_helper("xrandr --orientation", self.screen_rotate_randr, self.screen_rotate_xrandr)
 
     def screen_rotate_xrandr(self):
         rotation = str(self._screen_rotation)
@@ -442,68 +801,85 @@ class MWM(threading.Thread):
             ["xrandr", "--orientation", rotation, "--verbose"]
         )
 
-    def screen_rotate_xlib(self):
-        if self.display.has_extension('RANDR'):
-            logging.debug("screen rotate - getting screen")
-            screen = self.display.screen()
-            logging.debug("screen rotate - getting info")
-            info = screen.root.xrandr_get_screen_info()
-            logging.debug(f"info {pp.pformat(info)}")
-            logging.debug(
-                f"screen rotate - xrandr_set_screen_config {info.size_id} {self._screen_rotation} {info.config_timestamp}"
-            )
-            screen.root.xrandr_set_screen_config(
-                size_id=info.size_id,
-                rotation=self._screen_rotation,
-                config_timestamp=info.config_timestamp
-            )
+    def _has_extension(self, name: str) -> bool:
+        return self.conn.core.QueryExtension(len(name), name).reply().present
+
+    def _sync(self):
+        # any request with a reply waits for the server to process everything sent before it
+        self.conn.core.GetInputFocus().reply()
+
+    def screen_rotate_randr(self):
+        if self._randr is None:
+            raise RuntimeError("RANDR extension not available")
+        logging.debug("screen rotate - getting info")
+        info = self._randr.GetScreenInfo(self.screen.root).reply()
+        # same numbering as `xrandr --orientation`: 0 normal, 1 left, 2 inverted, 3 right
+        rotation = 1 << self._screen_rotation
+        logging.debug(
+            f"screen rotate - set_screen_config {info.sizeID} {rotation} {info.config_timestamp}"
+        )
+        self._randr.SetScreenConfig(
+            self.screen.root,
+            xcffib.xproto.Time.CurrentTime,
+            info.config_timestamp,
+            info.sizeID,
+            rotation,
+            0
+        ).reply()
 
     def screen_saver_disable(self):
-        screen_saver = self.display.get_screen_saver()
-        self.display.set_screen_saver(
-            timeout=0,
-            interval=screen_saver.interval,
-            prefer_blank=screen_saver.prefer_blanking,
-            allow_exposures=screen_saver.allow_exposures
+        self.set_screen_saver_timeout(0)
+
+    def set_screen_saver_timeout(self, timeout: int):
+        screen_saver = self.conn.core.GetScreenSaver().reply()
+        self.conn.core.SetScreenSaver(
+            timeout,
+            screen_saver.interval,
+            screen_saver.prefer_blanking,
+            screen_saver.allow_exposures
         )
+        self._sync()
+
+    def dpms_capable(self) -> bool:
+        if not self._has_extension('DPMS'):
+            return False
+        return bool(self.conn(xcffib.dpms.key).Capable().reply().capable)
 
     def dpms_disable(self):
-        if not hasattr(self.display, 'dpms_capable'):
+        if not self.dpms_capable():
             logging.info("dpms not capable")
             return
-        if self.display.dpms_capable():
-            logging.info("dpms disable")
-            self.display.dpms_disable()
-            self.display.sync()
+        logging.info("dpms disable")
+        self.conn(xcffib.dpms.key).Disable()
+        self._sync()
 
     def dpms_enable(self):
-        if not hasattr(self.display, 'dpms_capable'):
+        if not self.dpms_capable():
             logging.info("dpms not capable")
             return
-        if self.display.dpms_capable():
-            logging.info("dpms enable")
-            self.display.dpms_enable()
-            self.display.sync()
+        logging.info("dpms enable")
+        self.conn(xcffib.dpms.key).Enable()
+        self._sync()
 
     def display_off(self):
-        if self.display.dpms_capable():
+        if self.dpms_capable():
             self.dpms_enable()
             logging.info("screen off")
-            self.display.dpms_force_level(Xlib.ext.dpms.DPMSModeOff)
-            self.display.sync()
+            self.conn(xcffib.dpms.key).ForceLevel(xcffib.dpms.DPMSMode.Off)
+            self._sync()
 
     def display_on(self):
-        if self.display.dpms_capable():
+        if self.dpms_capable():
             logging.info("screen on")
-            self.display.dpms_force_level(Xlib.ext.dpms.DPMSModeOn)
-            self.display.sync()
+            self.conn(xcffib.dpms.key).ForceLevel(xcffib.dpms.DPMSMode.On)
+            self._sync()
         self.dpms_disable()
 
     @property
     def _dim_width(self) -> int:
         if self._border < 0:
-            return self.screen.width_in_pixels + (abs(self._border) * 2)
-        return self.screen.width_in_pixels
+            return self._screen_width + (abs(self._border) * 2)
+        return self._screen_width
 
     @property
     def _dim_x(self) -> int:
@@ -514,8 +890,8 @@ class MWM(threading.Thread):
     @property
     def _dim_height(self) -> int:
         if self._border < 0:
-            return self.screen.height_in_pixels + (abs(self._border) * 2)
-        return self.screen.height_in_pixels
+            return self._screen_height + (abs(self._border) * 2)
+        return self._screen_height
 
     @property
     def _dim_y(self) -> int:
@@ -529,65 +905,229 @@ class MWM(threading.Thread):
             return 0
         return self._border
 
-    def _handle_configure_request_event(self, event: xcffib.xproto.ConfigureRequestEvent):
-        logging.info(f"_handle_configure_request_event {pp.pformat(event)}")
+    def _update_target_geometry(self):
+        self._target_geometry = (self._dim_x, self._dim_y, self._dim_width, self._dim_height, self._dim_border)
+        logging.info(f"target window geometry: {self._target_geometry}")
 
-        self.conn.core.ConfigureWindow(
-            event.window,
-            xcffib.xproto.ConfigWindow.X |
-            xcffib.xproto.ConfigWindow.Y |
-            xcffib.xproto.ConfigWindow.Width |
-            xcffib.xproto.ConfigWindow.Height |
-            xcffib.xproto.ConfigWindow.BorderWidth |
-            xcffib.xproto.ConfigWindow.Sibling |
-            xcffib.xproto.ConfigWindow.StackMode,
-            [
-                self._dim_x,
-                self._dim_y,
-                self._dim_width,
-                self._dim_height,
-                self._dim_border,
-                # Siblings are windows that share the same parent. When configuring a window
-                # you can specify a sibling window and a stack mode. For example if you
-                # specify a sibling window and Above as the stack mode, the window
-                # will appear above the sibling window specified.
-                event.sibling,
-                # Stacking order is where the window should appear.
-                # For example above/below the sibling window above.
-                event.stack_mode
-            ]
+    def _handle_configure_request_event(self, event: xcffib.xproto.ConfigureRequestEvent):
+        logging.debug(
+            "ConfigureRequest - window: %s x: %s y: %s width: %s height: %s border_width: %s sibling: %s stack_mode: %s",
+            event.window, event.x, event.y, event.width, event.height, event.border_width, event.sibling,
+            event.stack_mode
         )
-        logging.info(
-            f"ConfigureRequest - window: {event.window} x: {event.x} y: {event.y} width: {event.width} height: {event.height} border_width: {event.border_width} sibling: {event.sibling} stack_mode: {event.stack_mode}"
+        # only the last request of the batch for each window is applied
+        self._pending_configures.pop(event.window, None)
+        self._pending_configures[event.window] = event
+
+    def _apply_pending_configures(self):
+        pending, self._pending_configures = self._pending_configures, {}
+        for window, event in pending.items():
+            try:
+                self._apply_configure_request(window, event)
+            except Exception as e:
+                logging.exception(e)
+
+    def _apply_configure_request(self, window: int, event: xcffib.xproto.ConfigureRequestEvent):
+        record = self._windows.get(window)
+        if record is None:
+            # destroyed, or never seen: a ConfigureWindow would only fail with BadWindow
+            logging.debug("ConfigureRequest - window: %s not tracked, ignored", window)
+            return
+        mask = 0
+        values = []
+        if record.geometry != self._target_geometry:
+            mask |= xcffib.xproto.ConfigWindow.X | \
+                xcffib.xproto.ConfigWindow.Y | \
+                xcffib.xproto.ConfigWindow.Width | \
+                xcffib.xproto.ConfigWindow.Height | \
+                xcffib.xproto.ConfigWindow.BorderWidth
+            values.extend(self._target_geometry)
+        # Siblings are windows that share the same parent. When configuring a window
+        # you can specify a sibling window and a stack mode. For example if you
+        # specify a sibling window and Above as the stack mode, the window
+        # will appear above the sibling window specified.
+        # Stacking order is where the window should appear.
+        # For example above/below the sibling window above.
+        if event.value_mask & xcffib.xproto.ConfigWindow.StackMode:
+            if event.value_mask & xcffib.xproto.ConfigWindow.Sibling:
+                mask |= xcffib.xproto.ConfigWindow.Sibling
+                values.append(event.sibling)
+            mask |= xcffib.xproto.ConfigWindow.StackMode
+            values.append(event.stack_mode)
+
+        if not mask:
+            # nothing would change: no configure/expose cycle, but tell the client where it is (ICCCM 4.1.5)
+            logging.debug("ConfigureRequest - window: %s already at %s", window, record.geometry)
+            self._send_configure_notify(window, record.geometry)
+            return
+        self.conn.core.ConfigureWindow(window, mask, values)
+        record.geometry = self._target_geometry
+
+    def _send_configure_notify(self, window: int, geometry: Geometry):
+        x, y, width, height, border_width = geometry
+        event = xcffib.xproto.ConfigureNotifyEvent.synthetic(
+            event=window,
+            window=window,
+            above_sibling=0,
+            x=x,
+            y=y,
+            width=width,
+            height=height,
+            border_width=border_width,
+            override_redirect=False
         )
+        self.conn.core.SendEvent(False, window, xcffib.xproto.EventMask.StructureNotify, event.pack())
+
+    def _handle_configure_notify_event(self, event: xcffib.xproto.ConfigureNotifyEvent):
+        record = self._windows.get(event.window)
+        if record is not None:
+            record.geometry = (event.x, event.y, event.width, event.height, event.border_width)
+
+    def _handle_screen_change_notify_event(self, event: xcffib.randr.ScreenChangeNotifyEvent):
+        logging.info(f"screen changed: {event.width}x{event.height} rotation {event.rotation}")
+        if (event.width, event.height) == (self._screen_width, self._screen_height):
+            return
+        self._screen_width = event.width
+        self._screen_height = event.height
+        self._update_target_geometry()
+        if self.main_window is not None:
+            self.conn.core.ConfigureWindow(
+                self.main_window,
+                xcffib.xproto.ConfigWindow.Width | xcffib.xproto.ConfigWindow.Height,
+                [event.width, event.height]
+            )
+            self._status_view.resize(event.width, event.height)
+        for window, record in self._windows.items():
+            if record.managed:
+                self._configure_window(window, record)
 
     def _handle_create_notify_event(self, event: xcffib.xproto.CreateNotifyEvent):
-        logging.info(f"_handle_create_notify_event {pp.pformat(event)}")
+        logging.debug("_handle_create_notify_event %s", LazyPformat(event))
+        if event.window == self.main_window:
+            # our own status window: selecting PropertyChange here would replace its event mask
+            return
         self.conn.core.MapWindow(event.window)
-        self._windows.add(event.window)
+        self._track_window(
+            event.window,
+            WindowRecord(
+                bool(event.override_redirect),
+                (event.x, event.y, event.width, event.height, event.border_width)
+            )
+        )
 
-    def _handle_destroy_notify_event(self, event: xcffib.xproto.DestroyNotifyEvent):
-        logging.info(f"_handle_destroy_notify_event {pp.pformat(event)}")
-        logging.info(
-            f"DestroyNotify: event {event.event} window {event.window}"
+    def _track_window(self, window: int, record: WindowRecord):
+        self._windows[window] = record
+        # keep _NET_WM_STATE of the window up to date through PropertyNotify events
+        self.conn.core.ChangeWindowAttributes(
+            window,
+            xcffib.xproto.CW.EventMask,
+            [xcffib.xproto.EventMask.PropertyChange]
         )
-        if event.window in self._windows:
-            self._windows.remove(event.window)
+        # the client may already have set the property before we selected the event
+        self._fetch_net_wm_state(window)
+
+    def _handle_destroy_notify_event(self, event: xcffib.xproto.DestroyNotifyEvent):
+        logging.debug("DestroyNotify: event %s window %s", event.event, event.window)
+        self._windows.pop(event.window, None)
+        self._pending_configures.pop(event.window, None)
+        self._net_wm_state.pop(event.window, None)
+        self._net_wm_state_own_writes.pop(event.window, None)
 
     def _handle_unmap_notify_event(self, event: xcffib.xproto.UnmapNotifyEvent):
-        logging.info(f"_handle_unmap_notify_event {pp.pformat(event)}")
-        logging.info(
-            f"UnmapNotify: event {event.event} window {event.window} from_configure {event.from_configure}"
+        logging.debug(
+            "UnmapNotify: event %s window %s from_configure %s", event.event, event.window, event.from_configure
         )
 
     def _handle_mapping_notify_event(self, event: xcffib.xproto.MappingNotifyEvent):
-        logging.info(f"_handle_mapping_notify_event {pp.pformat(event)}")
-        logging.info(
-            f"MappingNotify: request {event.request} first_keycode {event.first_keycode} count {event.count}"
+        logging.debug(
+            "MappingNotify: request %s first_keycode %s count %s", event.request, event.first_keycode, event.count
+        )
+
+    def _handle_leave_notify_event(self, event: xcffib.xproto.LeaveNotifyEvent):
+        logging.debug("X event: LeaveNotifyEvent %s", event.detail)
+
+    def _handle_key_press_event(self, event: xcffib.xproto.KeyPressEvent):
+        logging.debug(
+            "X event: KeyPressEvent time: %s root: %s event: %s child: %s root_x: %s root_y: %s event_x: %s event_y: %s state: %s keycode: %s same_screen: %s",
+            event.time, event.root, event.event, event.child, event.root_x, event.root_y, event.event_x, event.event_y,
+            event.state, event.detail, event.same_screen
+        )
+
+    def _handle_property_notify_event(self, event: xcffib.xproto.PropertyNotifyEvent):
+        logging.debug(
+            "X event: PropertyNotifyEvent window: %s state: %s atom: %s time: %s",
+            event.window, event.state, event.atom, event.time
+        )
+        if event.atom != self._NET_WM_STATE or event.window not in self._windows:
+            return
+        own_writes = self._net_wm_state_own_writes.get(event.window, 0)
+        if own_writes:
+            # the cache already holds what we wrote
+            self._net_wm_state_own_writes[event.window] = own_writes - 1
+        elif event.state == xcffib.xproto.Property.Delete:
+            self._net_wm_state[event.window] = set()
+        else:
+            self._fetch_net_wm_state(event.window)
+
+    def _fetch_net_wm_state(self, window: int):
+        """
+        Request the _NET_WM_STATE of `window` without waiting for the reply:
+        the reply is read after the batch has been flushed, or when a ClientMessage needs it.
+        """
+        cookie = self.conn.core.GetProperty(
+            False,
+            window,
+            self._NET_WM_STATE,
+            xcffib.xproto.Atom.ATOM,
+            0,
+            2 ** 32 - 1
         )
+        self._net_wm_state_pending.setdefault(window, []).append(cookie)
+        self._deferred.append(partial(self._get_net_wm_state, window))
+
+    def _get_net_wm_state(self, window: int) -> set[int]:
+        cookies = self._net_wm_state_pending.pop(window, None)
+        if cookies:
+            state = None
+            for cookie in cookies:
+                state = set(cookie.reply().value.to_atoms())
+            self._net_wm_state[window] = state
+            return state
+        if window in self._net_wm_state:
+            return self._net_wm_state[window]
+        # unknown window (created before we were running): blocking round trip
+        state = set(self.conn.core.GetProperty(
+            False,
+            window,
+            self._NET_WM_STATE,
+            xcffib.xproto.Atom.ATOM,
+            0,
+            2 ** 32 - 1
+        ).reply().value.to_atoms())
+        self._net_wm_state[window] = state
+        return state
+
+    def _run_deferred(self):
+        while self._deferred:
+            deferred, self._deferred = self._deferred, []
+            for fn in deferred:
+                try:
+                    fn()
+                except Exception as e:
+                    logging.exception(e)
+            # send what the deferred work requested
+            self.conn.flush()
+
+    def _handle_focus_event(self, event: xcffib.xproto.FocusInEvent | xcffib.xproto.FocusOutEvent):
+        logging.debug("X event: %s %s", type(event).__name__, event.mode)
+
+    def _handle_button_event(self, event: xcffib.xproto.ButtonPressEvent | xcffib.xproto.ButtonReleaseEvent):
+        logging.debug("X event: %s %s", type(event).__name__, event.detail)
+
+    def _handle_motion_notify_event(self, event: xcffib.xproto.MotionNotifyEvent):
+        logging.debug("X event: MotionNotifyEvent %s", event.detail)
 
     def _handle_map_request_event(self, event: xcffib.xproto.MapRequestEvent):
-        logging.info(f"_handle_map_request_event {pp.pformat(event)}")
         """
         When a window wants to map, meaning make itself visible, it send a MapRequestEvent that
         gets send to the window manager. Here we add it to our client list and finish by sending
@@ -595,36 +1135,66 @@ class MWM(threading.Thread):
         visible.
         :param event: MapRequestEvent to handle
         """
-
-        # Get attributes associated with the window
-        attributes = self.conn.core.GetWindowAttributes(
-            event.window
-        ).reply()
+        logging.debug("_handle_map_request_event %s", LazyPformat(event))
+        if self._timeline.finished_at is None:
+            self._finish_startup_timeline()
+
+        # attributes associated with the window, recorded on CreateNotify
+        record = self._windows.get(event.window)
+        if record is None:
+            # window created before we selected SubstructureNotify: ask the server, but read the
+            # reply only once the batch has been flushed
+            cookie = self.conn.core.GetWindowAttributes(event.window)
+            self._deferred.append(partial(self._map_unknown_window, event.window, cookie))
+            return
 
         # If the window has the override_redirect attribute set as true then the window manager
         # should not manage the window.
-        if attributes.override_redirect:
+        if record.override_redirect:
             return
 
+        self._map_window(event.window)
+
+    def _finish_startup_timeline(self):
+        self._timeline.mark("first MapRequest")
+        if not self._timeline.finish():
+            return
+        if self._profile_startup:
+            print(f"startup profile {self._timeline.name}:\n{self._timeline.format_table()}", flush=True)
+        if self._startup_trace:
+            try:
+                self._timeline.write_chrome_trace(self._startup_trace)
+            except OSError as e:
+                logging.warning(f"cannot write the startup trace {self._startup_trace}: {e}")
+
+    def _map_unknown_window(self, window: int, cookie):
+        attributes = cookie.reply()
+        self._track_window(window, WindowRecord(bool(attributes.override_redirect)))
+        if not attributes.override_redirect:
+            self._map_window(window)
+
+    def _map_window(self, window: int):
         # Send map window request to server, telling the server to make this window visible
-        self.conn.core.MapWindow(event.window)
+        self.conn.core.MapWindow(window)
+
+        record = self._windows[window]
+        record.managed = True
+        self._configure_window(window, record)
 
+    def _configure_window(self, window: int, record: WindowRecord):
+        if record.geometry == self._target_geometry:
+            return
         # Resize the window to take up whole screen
         self.conn.core.ConfigureWindow(
-            event.window,
+            window,
             xcffib.xproto.ConfigWindow.X |
             xcffib.xproto.ConfigWindow.Y |
             xcffib.xproto.ConfigWindow.Width |
             xcffib.xproto.ConfigWindow.Height |
             xcffib.xproto.ConfigWindow.BorderWidth,
-            [
-                self._dim_x,
-                self._dim_y,
-                self._dim_width,
-                self._dim_height,
-                self._dim_border,
-            ]
+            list(self._target_geometry)
         )
+        record.geometry = self._target_geometry
 
     def _handle_client_message_event(self, event):
         if event.format == 32:
@@ -634,22 +1204,14 @@ class MWM(threading.Thread):
         if event.format == 8:
             data = event.data.data8
 
-        logging.info(
-            f"X event: ClientMessageEvent window: {event.window} format: {event.format} type: {event.type} data: {data}"
+        logging.debug(
+            "X event: ClientMessageEvent window: %s format: %s type: %s data: %s",
+            event.window, event.format, event.type, data
         )
         # check if the event is a _NET_WM_STATE event
         if event.type == self._NET_WM_STATE:
-            # get window property _NET_WM_STATE
-            current_state = self.conn.core.GetProperty(
-                False,
-                event.window,
-                self._NET_WM_STATE,
-                xcffib.xproto.Atom.ATOM,
-                0,
-                2 ** 32 - 1
-            ).reply().value.to_atoms()
-            current_state = set(current_state)
-            logging.info(f"current state: {current_state}")
+            current_state = set(self._get_net_wm_state(event.window))
+            logging.debug("current state: %s", current_state)
             action = data[0]
             for prop in (data[1], data[2]):
                 if not prop:
@@ -661,17 +1223,20 @@ class MWM(threading.Thread):
                 elif action == _NET_WM_STATE_TOGGLE:
                     current_state ^= set([prop])
 
-                # send
-                self.conn.core.ChangeProperty(
-                    xcffib.xproto.PropMode.Replace,
-                    event.window,
-                    self._NET_WM_STATE,
-                    xcffib.xproto.Atom.ATOM,
-                    32,
-                    len(current_state),
-                    list(current_state)
-                )
-                self.conn.flush()
+            # send
+            self.conn.core.ChangeProperty(
+                xcffib.xproto.PropMode.Replace,
+                event.window,
+                self._NET_WM_STATE,
+                xcffib.xproto.Atom.ATOM,
+                32,
+                len(current_state),
+                list(current_state)
+            )
+            self._net_wm_state[event.window] = current_state
+            if event.window in self._windows:
+                self._net_wm_state_own_writes[event.window] = \
+                    self._net_wm_state_own_writes.get(event.window, 0) + 1
 
         if False:  # event.type == self.??:
             logging.info("create window")
@@ -692,7 +1257,7 @@ class MWM(threading.Thread):
             )
             self.conn.core.MapWindow(new_id)
             self.conn.flush()
-            self._windows.add(new_id)
+            self._windows[new_id] = WindowRecord(False)
             # reply
             reply_event = xcffib.xproto.ClientMessageEvent.synthetic(
                 format=32,
@@ -711,44 +1276,88 @@ class MWM(threading.Thread):
             )
             self.conn.flush()
 
-    def get_event(self) -> Any | None | bool:
-        time.sleep(1)
+    def get_events(self, timeout: float = 1.0) -> Optional[List[Any]]:
+        """
+        Wait until the X connection is readable and drain every queued event.
+        :param timeout: seconds to wait for the connection to become readable
+        :return: the events read (empty on timeout) or None if the connection is broken
+        """
+        events = self._drain_events()
+        if events is None or events:
+            return events
+        self.conn.flush()
+        if self._poller is None:
+            self._poller = select.poll()
+            self._poller.register(self.conn.get_file_descriptor(), select.POLLIN)
+            self._poller.register(self._wakeup_r, select.POLLIN)
+        for fd, _ in self._poller.poll(timeout * 1000):
+            if fd == self._wakeup_r:
+                self._drain_wakeup()
+        return self._drain_events()
+
+    def _drain_wakeup(self):
         try:
-            return self.conn.wait_for_event()
-        except xcffib.ConnectionException as ce:
-            logging.warning("X connection error")
-            logging.exception(ce)
-            return False
-        except xcffib.xproto.WindowError as e:
-            logging.warning("X window error")
-            self.conn.flush()
-            logging.exception(e)
-            return True
-        except Exception as e:
-            logging.exception(e)
-            return True
-
-    def _kill_processes(self):
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
 
-        for process in self._processes:
+    def _wakeup(self):
+        if self._wakeup_w is None:
+            return
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            # a wakeup is already pending
+            pass
+
+    def _drain_events(self) -> Optional[List[Any]]:
+        events = []
+        while True:
             try:
-                if process.returncode is not None:
-                    continue
-                logging.info(f"terminating {process.args}")
-                process.terminate()
-                if process.wait(30) is None:
-                    logging.info(f"killing {process.args}")
-                    os.kill(process.pid, Signals.SIGKILL)
+                event = self.conn.poll_for_event()
+            except xcffib.ConnectionException as ce:
+                logging.warning("X connection error")
+                logging.exception(ce)
+                return None
+            except xcffib.xproto.WindowError as e:
+                logging.warning("X window error")
+                logging.exception(e)
+                continue
             except Exception as e:
                 logging.exception(e)
+                continue
+            if event is None:
+                return events
+            events.append(event)
+
+    def stop(self):
+        """
+        Stop the viewer and the child processes, Xorg included; the event loop ends with the X connection.
+        """
+        self._kill_processes()
+
+    def _kill_processes(self):
+        self._stopping.set()
+        try:
+            self._supervisor.terminate_all()
+        except Exception as e:
+            logging.exception(e)
 
     def __del__(self):
-        if self.display:
+        if getattr(self, 'conn', None):
             try:
-                self.display.close()
+                self.conn.disconnect()
             except Exception:
                 pass
+            self.conn = None
+        REGISTRY.unregister_collector(self._collect_metrics)
         self._kill_processes()
+        self._close_recorder()
+        for fd in (getattr(self, '_wakeup_r', None), getattr(self, '_wakeup_w', None)):
+            if fd is not None:
+                os.close(fd)
+        self._wakeup_r = self._wakeup_w = None
 
     def __enter__(self) -> "MWM":
         return self
@@ -843,13 +1452,49 @@ def main():
     parser.add_argument('-t', '--vt', choices=range(1, 10), type=int, default=8)
     parser.add_argument('-l', '--log-level', action=StoreLogLevel)
     parser.add_argument('-f', '--log-file', default='./proxmox-desktop.log', type=Path)
+    parser.add_argument('--log-child-output', action='store_true', default=False,
+                        help='log every output line of Xorg and the helper processes, not only summaries')
     parser.add_argument('-nx', '--no-x', action='store_true', default=False)
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help='drive every ttyN seat of the [vm] section from this process')
+    parser.add_argument('--trace-events', action='store_true', default=False)
+    parser.add_argument('--external-helpers', action='store_true', default=False,
+                        help='use chvt, xset and xrandr instead of applying the settings in-process')
+    parser.add_argument('--warm-reconnect', action='store_true', default=False,
+                        help='reconnect the viewer in-process when it exits, keeping the VM location')
+    parser.add_argument('--reconnect-prefetch', type=float, default=None,
+                        help='with --warm-reconnect, seconds between SPICE ticket prefetches during the session; '
+                             'below 25, the lifetime of a ticket')
+    parser.add_argument('--wait-vm', action='store_true', default=False,
+                        help='wait for the VM to run instead of exiting when it is not running')
+    parser.add_argument('--start-vm', action='store_true', default=False,
+                        help='with --wait-vm, start the VM if it is stopped')
+    parser.add_argument('--profile-startup', action='store_true', default=False,
+                        help='print a table of the startup phases once the viewer window is mapped')
+    parser.add_argument('--startup-trace', default=None,
+                        help='write the startup phases to this file in Chrome trace format; {vt} is replaced by the vt')
+    parser.add_argument('--process-output-dir', default=None,
+                        help='write the buffered output of a child process (Xorg, helpers) to this directory '
+                             'when it exits with an error or the seat fails')
+    parser.add_argument('--process-output-buffer', type=int, default=256,
+                        help='KiB of output kept in memory per child process')
+    parser.add_argument('--record-events', default=None,
+                        help='record the received X events to this file for proxmox-desktop-replay; '
+                             '{vt} is replaced by the vt')
+    parser.add_argument('--metrics-textfile', default=None,
+                        help='write Prometheus metrics to this file for the node exporter textfile collector')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
     parser.add_argument('--proxmox-host', default=None)
     parser.add_argument('--proxmox-backend', default="local", choices=["local", "openssh", "https", "ssh_paramiko"])
     parser.add_argument('--remote-viewer-path', default='/usr/bin/remote-viewer')
     parser.add_argument('--proxmox-user', default=None)
     parser.add_argument('--proxmox-password', default=None)
     parser.add_argument('--proxmox-verify-ssl', type=bool, default=None)
+    parser.add_argument('--proxmox-resource-ttl', type=float, default=None)
+    parser.add_argument('--proxmox-ticket-cache-dir', default=None)
+    parser.add_argument('--proxmox-spice-proxy', default=None)
+    parser.add_argument('--proxmox-spice-proxy-ttl', type=float, default=None)
     parser.add_argument('--config', default='/etc/proxmox-desktop/config.ini', type=Path)
     args = parser.parse_args()
 
@@ -863,7 +1508,20 @@ def main():
     if 'main' in config:
         for k, v in config['main'].items():
             if k in vars(args):
+                # store_true flags: 'false' would be a true string
+                if isinstance(getattr(args, k), bool):
+                    v = config['main'].getboolean(k)
                 setattr(args, k, v)
+    setup_logging(args.log_level, args.log_file)
+    # config values skip the argparse types: reject a bad interval before any seat starts
+    args.reconnect_prefetch = parse_prefetch_interval(args.reconnect_prefetch)
+    log_child_output(args.log_child_output)
+    start_metrics(args.metrics_textfile, args.metrics_port)
+
+    if args.daemon:
+        run_daemon(args, config)
+        return
+
     if args.vmid is None and args.vt is None:
         raise ValueError("vmid or vt is required")
 
@@ -873,13 +1531,60 @@ def main():
                 args.vmid = config['vm'].getint(f'tty{args.vt}')
             else:
                 raise ValueError(f"no configuration for tty{args.vt} in [vm] section")
+    kwargs = vars(args)
+    for k in ('daemon', 'config', 'log_level', 'log_file', 'log_child_output', 'metrics_textfile', 'metrics_port'):
+        del kwargs[k]
     try:
-        with MWM(**vars(args)) as wm:
+        with MWM(**kwargs) as wm:
+            # kill -USR1 <pid> dumps the per event type counters and timings to the log
+            signal.signal(signal.SIGUSR1, lambda signum, frame: wm.dump_event_stats())
+            # kill -USR2 <pid> toggles the per event debug trace
+            signal.signal(signal.SIGUSR2, lambda signum, frame: wm.toggle_event_trace())
             wm.start()
             wm.join()
     except Exception as e:
         logging.exception(e)
 
 
+def start_metrics(textfile: Optional[str], port: Optional[int]):
+    if textfile:
+        TextfileWriter(str(textfile)).start()
+        logging.info(f"writing metrics to {textfile}")
+    if port:
+        server = MetricsServer(port=int(port))
+        server.start()
+        logging.info(f"serving metrics on http://127.0.0.1:{server.port}/metrics")
+
+
+def run_daemon(args, config):
+    from proxmox_desktop.seats import SeatDaemon, seats_from_config
+
+    seats = seats_from_config(config)
+    if not seats:
+        raise ValueError("no ttyN entry in the [vm] section")
+    kwargs = vars(args)
+    # per seat options
+    for k in ('daemon', 'config', 'log_level', 'log_file', 'log_child_output', 'metrics_textfile', 'metrics_port',
+              'vmid', 'vt', 'display'):
+        del kwargs[k]
+    proxmox = make_proxmox_viewer(**kwargs)
+    mwm_kwargs = {k: v for k, v in kwargs.items() if not k.startswith('proxmox_') and k != 'remote_viewer_path'}
+    daemon = SeatDaemon(seats, proxmox, **mwm_kwargs)
+
+    def dump_event_stats():
+        for wm in daemon.wms():
+            wm.dump_event_stats()
+
+    def toggle_event_trace():
+        for wm in daemon.wms():
+            wm.toggle_event_trace()
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump_event_stats())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: toggle_event_trace())
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    daemon.start()
+    daemon.join()
+
+
 if __name__ == '__main__':
     main()
@@ -3,77 +3,579 @@ import logging
 import os
 import subprocess
 import tempfile
+import threading
 import time
-from typing import Optional, List
+from concurrent.futures import Future
+from threading import Thread
+from typing import Any, Callable, Dict, NamedTuple, Optional, List, Tuple, TypeVar
 
-from proxmoxer import ProxmoxAPI
+import requests
+from proxmoxer import ProxmoxAPI, ResourceException
+from proxmoxer.core import AuthenticationError
+
+from proxmox_desktop.backoff import Backoff
+from proxmox_desktop.cluster_index import ClusterResourceIndex, VmLocation
+from proxmox_desktop.metrics import REGISTRY
+from proxmox_desktop.spice_proxy import SpiceProxySelector, proxy_url
+from proxmox_desktop.timeline import Timeline, activate, span
+from proxmox_desktop.ticket_cache import Ticket, TicketAuth, TicketCache, ticket_api
+
+T = TypeVar('T')
+
+# log in again once the ticket in use is this old (PVE tickets last 2 hours)
+_TICKET_RENEW_AGE = 3600
+
+# the SPICE password returned by spiceproxy expires after 30 seconds; keep a margin for the exec
+_SPICE_TICKET_MAX_AGE = 25.0
+
+# seconds between checks of the stop event while remote-viewer runs
+_STOP_POLL_INTERVAL = 0.5
+
+# VM status polling while waiting for it to run: the interval starts at the minimum, grows while
+# nothing changes and is kept short while a start task is running
+_WAIT_POLL_MIN = 1.0
+_WAIT_POLL_MAX = 15.0
+_WAIT_POLL_FACTOR = 1.5
+_WAIT_POLL_TASK = 1.0
+
+
+def parse_prefetch_interval(value: Optional[Any]) -> Optional[float]:
+    """
+    Validate a SPICE ticket prefetch interval from the command line or the config.
+    A ticket older than _SPICE_TICKET_MAX_AGE is fetched again on reconnect, so a longer interval
+    would only prefetch tickets already expired.
+    :raise ValueError: not a number of seconds between 0 and _SPICE_TICKET_MAX_AGE
+    """
+    if value is None:
+        return None
+    interval = float(value)
+    if not 0 < interval < _SPICE_TICKET_MAX_AGE:
+        raise ValueError(
+            f"ticket prefetch interval must be between 0 and {_SPICE_TICKET_MAX_AGE:.0f} seconds "
+            f"(SPICE ticket lifetime), got {value}"
+        )
+    return interval
+
+
+# tmpfs directories for the connection file when memfd_create is not available
+_TMPFS_DIRS = ('/dev/shm', os.getenv('XDG_RUNTIME_DIR'))
+
+
+def _connection_fd(data: Dict[str, Any]) -> int:
+    """
+    Write the .vv content to an anonymous in-memory file, to be opened by remote-viewer
+    through /proc/self/fd/N: nothing touches the disk and nothing is left behind.
+    memfd_create is used when available, else an unlinked file on a tmpfs.
+    """
+    # remote-viewer cannot delete a /proc/self/fd path: the file goes away with the last fd
+    content = "[virt-viewer]\n" + "".join(f"{k}={v}\n" for k, v in data.items() if k != 'delete-this-file')
+    try:
+        fd = os.memfd_create("proxmox-desktop.vv", os.MFD_CLOEXEC)
+    except (AttributeError, OSError):
+        tmpdir = next((d for d in _TMPFS_DIRS if d and os.path.isdir(d)), None)
+        fd, path = tempfile.mkstemp(suffix='.vv', dir=tmpdir)
+        os.unlink(path)
+    try:
+        view = memoryview(content.encode())
+        while view:
+            view = view[os.write(fd, view):]
+        os.lseek(fd, 0, os.SEEK_SET)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+_SPICEPROXY = 'nodes/{node}/qemu/{vmid}/spiceproxy'
+
+_API_SECONDS = REGISTRY.histogram(
+    'api_request_seconds', 'Proxmox API call latency, login included for the login endpoint', ('endpoint',))
+_API_ERRORS = REGISTRY.counter('api_errors_total', 'Proxmox API calls that raised', ('endpoint',))
+_SESSIONS = REGISTRY.counter('viewer_sessions_total', 'remote-viewer sessions started', ('vmid',))
+_RECONNECTS = REGISTRY.counter('viewer_reconnects_total', 'remote-viewer sessions started again in-process', ('vmid',))
+_SESSION_SECONDS = REGISTRY.histogram(
+    'viewer_session_seconds', 'remote-viewer session duration', ('vmid',),
+    buckets=(1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400))
+_RECONNECT_SECONDS = REGISTRY.histogram(
+    'viewer_reconnect_seconds', 'time from the exit of remote-viewer to the next exec, backoff included', ('vmid',))
+
+
+class VmNotRunning(ValueError):
+    def __init__(self, location: VmLocation):
+        super().__init__(f"VM {location.vmid} is not running ({location.status})")
+        self.location = location
+
+
+class SpiceTicket(NamedTuple):
+    data: Dict[str, Any]
+    fetched_at: float
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    @property
+    def fresh(self) -> bool:
+        return self.age < _SPICE_TICKET_MAX_AGE
 
 
 class ProxmoxViewer:
+    """
+    Proxmox API client and remote-viewer launcher. A single instance can be shared by several seats:
+    the API client, the ticket cache and the cluster index are thread safe.
+    """
+
+    # a viewer session lasting this long resets its restart backoff
+    restart_healthy_after = 60.0
+
     def __init__(self, host: Optional[str] = None, backend="local",
                  remote_viewer_path='/usr/bin/remote-viewer',
+                 resource_ttl: Optional[float] = None,
+                 ticket_cache_dir: Optional[str] = None,
+                 spice_proxy: Optional[str] = None,
+                 spice_proxy_ttl: Optional[float] = None,
+                 api: Optional[Any] = None,
                  **kwargs):
+        """
+        :param spice_proxy: choose the SPICE proxy by TCP connect time: `cluster` measures every online
+            cluster node, otherwise a comma separated list of candidate hosts; None leaves the choice to the server
+        :param spice_proxy_ttl: seconds the proxy ranking is kept
+        :param api: API client to use instead of a ProxmoxAPI built from the options (benchmarks)
+        """
         self.remote_viewer_path = remote_viewer_path
         # remove null value from kwargs
-        kwargs = {k: v for k, v in kwargs.items() if v is not None}
-        self._proxmox = ProxmoxAPI(host=host, service="PVE", backend=backend, **kwargs)
-        self._restart_delay = 5
+        self._api_kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        self._api_kwargs.update(host=host, service="PVE", backend=backend)
+        # the API client (and the login it implies) is created on first use, see `prepare`
+        self._api: Optional[ProxmoxAPI] = api
+        self._api_lock = threading.Lock()
+        # (vmid, node) -> lookup started by `prepare`
+        self._prepared: Dict[Tuple[Optional[int], Optional[str]], Future] = {}
+        self._prepared_lock = threading.Lock()
+        # https backend with a password: keep the auth ticket on disk, so that restarts skip the login
+        self._ticket: Optional[Ticket] = None
+        # the client in use was built from the cached ticket, not yet accepted by the server
+        self._ticket_unverified = False
+        self._ticket_cache: Optional[TicketCache] = None
+        if backend == 'https' and self._api_kwargs.get('user') and self._api_kwargs.get('password'):
+            self._ticket_cache = TicketCache(host, self._api_kwargs['user'], cache_dir=ticket_cache_dir)
+        # where the VMs are and whether they run, one cluster/resources call for the whole cluster
+        self._resources = ClusterResourceIndex(
+            lambda: self._api_call('cluster/resources', lambda api: api.cluster.resources.get(type='vm')),
+            ttl=float(resource_ttl) if resource_ttl is not None else 10.0
+        )
+        self._spice_proxy: Optional[SpiceProxySelector] = None
+        if spice_proxy:
+            if spice_proxy == 'cluster':
+                candidates = self._cluster_node_addresses
+            else:
+                hosts = [h.strip() for h in spice_proxy.split(',') if h.strip()]
+                candidates = lambda: hosts
+            self._spice_proxy = SpiceProxySelector(
+                candidates, ttl=float(spice_proxy_ttl) if spice_proxy_ttl is not None else 300.0
+            )
+
+    @property
+    def _proxmox(self) -> ProxmoxAPI:
+        """
+        The API client. A single client is kept for the life of the process, so the https backend
+        reuses one keep-alive session for every call.
+        """
+        if self._api is None or self._ticket_needs_renewal():
+            with self._api_lock:
+                if self._api is None or self._ticket_needs_renewal():
+                    self._api = self._connect(use_cached_ticket=self._api is None)
+        return self._api
+
+    def _ticket_needs_renewal(self) -> bool:
+        return self._ticket is not None and self._ticket.age >= _TICKET_RENEW_AGE
+
+    def _connect(self, use_cached_ticket: bool = True) -> ProxmoxAPI:
+        with span("proxmox login"):
+            return self._login(use_cached_ticket)
+
+    def _login(self, use_cached_ticket: bool) -> ProxmoxAPI:
+        start = time.monotonic()
+        api = None
+        self._ticket_unverified = False
+        if self._ticket_cache is not None and use_cached_ticket:
+            ticket = self._ticket_cache.load()
+            if ticket is not None:
+                api = self._api_from_ticket(ticket)
+        if api is None:
+            try:
+                api = ProxmoxAPI(**self._api_kwargs)
+            except Exception:
+                _API_ERRORS.inc("login")
+                raise
+            _API_SECONDS.observe(time.monotonic() - start, "login")
+            if self._ticket_cache is not None:
+                self._store_ticket(api)
+            logging.info(f"proxmox api client ready in {(time.monotonic() - start) * 1000:.1f} ms")
+        else:
+            logging.info(f"proxmox api client ready with a cached ticket in {(time.monotonic() - start) * 1000:.1f} ms")
+        return api
+
+    def _api_from_ticket(self, ticket: Ticket) -> Optional[ProxmoxAPI]:
+        kwargs = self._api_kwargs
+        try:
+            auth = TicketAuth(
+                ticket,
+                timeout=float(kwargs.get('timeout', 5)),
+                service=kwargs['service'],
+                verify_ssl=kwargs.get('verify_ssl', True)
+            )
+            api = ticket_api(auth, kwargs['host'], port=kwargs.get('port'), path_prefix=kwargs.get('path_prefix'))
+        except Exception as e:
+            logging.warning(f"cannot use the cached ticket: {e!r}")
+            return None
+        self._ticket = ticket
+        self._ticket_unverified = True
+        return api
+
+    def _store_ticket(self, api: ProxmoxAPI):
+        ticket, csrf_token = api.get_tokens()
+        if not ticket:
+            return
+        self._ticket = Ticket(ticket, csrf_token)
+        try:
+            self._ticket_cache.save(self._ticket)
+        except OSError as e:
+            logging.warning(f"cannot write ticket cache {self._ticket_cache.path}: {e}")
+
+    def _api_call(self, endpoint: str, call: Callable[[ProxmoxAPI], T]) -> T:
+        """
+        Run `call` with the API client; a cached ticket rejected by the server is dropped
+        and the call is retried once after a fresh login.
+
+        :param endpoint: path template of the call, the label of its latency metrics
+        """
+        try:
+            result = self._timed_call(endpoint, call, self._proxmox)
+        except Exception as e:
+            if not self._ticket_rejected(e):
+                raise
+            logging.warning(f"ticket rejected ({e!r}), logging in again")
+            self._ticket_cache.clear()
+            with self._api_lock:
+                self._api = self._connect(use_cached_ticket=False)
+            return self._timed_call(endpoint, call, self._api)
+        self._ticket_unverified = False
+        return result
+
+    def _ticket_rejected(self, e: Exception) -> bool:
+        """
+        :return: True if `e` means the ticket in use is not accepted, so that a password login may help
+        """
+        if self._ticket_cache is None:
+            return False
+        if isinstance(e, ResourceException):
+            return e.status_code == 401
+        if isinstance(e, AuthenticationError):
+            return True
+        # a client from the cached ticket that never worked: anything but a network error is blamed on it
+        return self._ticket_unverified and not isinstance(e, requests.RequestException)
+
+    @staticmethod
+    def _timed_call(endpoint: str, call: Callable[[ProxmoxAPI], T], api: ProxmoxAPI) -> T:
+        start = time.monotonic()
+        try:
+            return call(api)
+        except Exception:
+            _API_ERRORS.inc(endpoint)
+            raise
+        finally:
+            _API_SECONDS.observe(time.monotonic() - start, endpoint)
+
+    def _cluster_node_addresses(self) -> List[str]:
+        status = self._api_call('cluster/status', lambda api: api.cluster.status.get())
+        return [n['ip'] for n in status if n.get('type') == 'node' and n.get('online') and n.get('ip')]
+
+    def prepare(self, vmid: Optional[int] = None, node: Optional[str] = None,
+                timeline: Optional[Timeline] = None) -> Future:
+        """
+        Log in and look up the node and the VM on a background thread, so that the work overlaps
+        with the X server startup. The next `remote_viewer` call for the same vmid and node uses the result.
+        """
+        future = Future()
+
+        def _prepare():
+            try:
+                with activate(timeline), span("proxmox lookup"):
+                    future.set_result(self._resolve(vmid, node))
+            except BaseException as e:
+                future.set_exception(e)
+
+        with self._prepared_lock:
+            self._prepared[(vmid, node)] = future
+        Thread(target=_prepare, name="proxmox-prepare", daemon=True).start()
+        return future
+
+    def _resolve(self, vmid: Optional[int], node: Optional[str]) -> Tuple[int, str]:
+        if vmid is None:
+            location = self._resources.first_running(node)
+            if location is None:
+                raise ValueError("No running VM found")
+        else:
+            location = self._resources.lookup(vmid)
+            if location is None:
+                raise ValueError(f"VM {vmid} not found in the cluster")
+        if node is not None and node != location.node:
+            logging.warning(f"VM {location.vmid} is on node {location.node}, not on {node}")
+        logging.info(f"using node {location.node}")
+        logging.info(f"using vmid {location.vmid}")
+        if location.status != 'running':
+            raise VmNotRunning(location)
+        return location.vmid, location.node
+
+    def wait_running(self,
+                     location: VmLocation,
+                     auto_start: bool = False,
+                     status: Optional[Callable[[str], None]] = None,
+                     stop: Optional[threading.Event] = None) -> Optional[Tuple[int, str]]:
+        """
+        Wait for the VM to be running, following its status (and, with `auto_start`, the task
+        starting it) with adaptive polling.
+
+        :param auto_start: start the VM if it is stopped
+        :param status: called with a progress message at every poll
+        :param stop: when set, stop waiting
+        :return: the vmid and node of the running VM, or None if `stop` was set
+        """
+        vmid, node = location.vmid, location.node
+        report = status if status is not None else (lambda msg: None)
+        started = time.monotonic()
+        upid = None
+        if auto_start and location.status == 'stopped':
+            logging.info(f"starting VM {vmid} on {node}")
+            report(f"starting VM {vmid}...")
+            upid = self._api_call(
+                'nodes/{node}/qemu/{vmid}/status/start', lambda api: api.nodes(node).qemu(vmid).status.start.post())
+        interval = _WAIT_POLL_MIN
+        last_state = location.status
+        while True:
+            try:
+                if upid is not None:
+                    task = self._api_call(
+                        'nodes/{node}/tasks/{upid}/status', lambda api: api.nodes(node).tasks(upid).status.get())
+                    if task.get('status') == 'stopped':
+                        if task.get('exitstatus') != 'OK':
+                            logging.warning(f"start of VM {vmid} failed: {task.get('exitstatus')}")
+                            report(f"start of VM {vmid} failed: {task.get('exitstatus')}")
+                        upid = None
+                current = self._api_call(
+                    'nodes/{node}/qemu/{vmid}/status/current', lambda api: api.nodes(node).qemu(vmid).status.current.get())
+            except ResourceException as e:
+                # the VM may have moved to another node
+                logging.warning(f"cannot get the status of VM {vmid} on {node}: {e}")
+                self._resources.invalidate()
+                found = self._resources.lookup(vmid)
+                if found is None:
+                    raise ValueError(f"VM {vmid} not found in the cluster")
+                node = found.node
+                current = {'status': found.status}
+            state = current.get('qmpstatus') or current.get('status', 'unknown')
+            elapsed = time.monotonic() - started
+            if state == 'running':
+                self._resources.invalidate()
+                logging.info(f"VM {vmid} running after {elapsed:.1f} seconds")
+                report(f"VM {vmid} is running, connecting...")
+                return vmid, node
+            if state != last_state:
+                logging.info(f"VM {vmid}: {state}")
+                last_state = state
+                interval = _WAIT_POLL_MIN
+            else:
+                interval = min(_WAIT_POLL_MAX, interval * _WAIT_POLL_FACTOR)
+            if upid is not None:
+                interval = min(interval, _WAIT_POLL_TASK)
+            report(f"waiting for VM {vmid} to run ({state}, {elapsed:.0f} s)...")
+            if stop is None:
+                time.sleep(interval)
+            elif stop.wait(interval):
+                return None
 
     def remote_viewer(self,
                       vmid: Optional[int] = None,
                       node: Optional[str] = None,
                       args: Optional[List[str]] = None,
-                      restart: bool = False) -> None:
-        start_time = time.time()
-        if node is None:
-            node = self._proxmox.nodes.get()[0]['node']
-        logging.info(f"using node {node}")
-        if vmid is None:
-            vms = self._proxmox.nodes(node).qemu.get()
-            for vm in vms:
-                if vm['status'] == 'running':
-                    vmid = vm['vmid']
-                    break
-        if vmid is None:
-            raise ValueError("No running VM found")
-        logging.info(f"using vmid {vmid}")
-        vm_info = self._proxmox.nodes(node).qemu(vmid)
-        if vm_info.status.current.get()['status'] != 'running':
-            raise ValueError(f"VM {vmid} is not running")
-
-        spiceproxy_data = vm_info.spiceproxy.post()
-
-        tmppath = tempfile.mktemp()
-        with open(tmppath, 'w') as f:
-            f.write("[virt-viewer]\n")
-            for k, v in spiceproxy_data.items():
-                f.write(f"{k}={v}\n")
+                      restart: bool = False,
+                      warm: bool = False,
+                      prefetch_interval: Optional[float] = None,
+                      stop: Optional[threading.Event] = None,
+                      wait_running: bool = False,
+                      auto_start: bool = False,
+                      status: Optional[Callable[[str], None]] = None,
+                      timeline: Optional[Timeline] = None) -> Optional[int]:
+        """
+        :param restart: start the viewer again when it exits
+        :param warm: on restart keep the node and the VM of the previous session and only fetch a new
+            SPICE ticket, as soon as the exit is seen
+        :param prefetch_interval: with `warm`, fetch a new ticket every `prefetch_interval` seconds
+            while the viewer runs, so that a reconnect does not wait for the API
+        :param stop: when set, the viewer is terminated and no new one is started
+        :param wait_running: wait for a VM that is not running instead of raising VmNotRunning
+        :param auto_start: with `wait_running`, start a stopped VM
+        :param status: called with progress messages while waiting
+        :param timeline: startup timeline the API calls and the exec are recorded on
+        :return: without `restart`, the exit code of remote-viewer; None when stopped
+        """
+        with activate(timeline):
+            restart_backoff = Backoff(
+                "remote-viewer", initial=1.0, maximum=60.0, healthy_after=self.restart_healthy_after)
+            location: Optional[Tuple[int, str]] = None
+            ticket: Optional[SpiceTicket] = None
+            exited_at: Optional[float] = None
+            while True:
+                try:
+                    if location is None:
+                        location = self._locate(vmid, node)
+                    if ticket is None or not ticket.fresh:
+                        ticket, location = self._fetch_spice_ticket(location, retry_cold=warm)
+                except VmNotRunning as e:
+                    if not wait_running:
+                        raise
+                    with span("wait for vm running"):
+                        location = self.wait_running(e.location, auto_start=auto_start, status=status, stop=stop)
+                    if location is None:
+                        return
+                    ticket, location = self._fetch_spice_ticket(location)
+                vmid, node = location
+                if exited_at is not None:
+                    logging.info(
+                        f"reconnecting to vm {vmid} after {(time.monotonic() - exited_at) * 1000:.1f} ms "
+                        f"(ticket {ticket.age * 1000:.0f} ms old)"
+                    )
+                    _RECONNECTS.inc(vmid)
+                    _RECONNECT_SECONDS.observe(time.monotonic() - exited_at, vmid)
+                _SESSIONS.inc(vmid)
+                start_time = time.monotonic()
+                exitcode, ticket = self._run_remote_viewer(
+                    location, ticket, args,
+                    prefetch_interval=prefetch_interval if restart and warm else None,
+                    stop=stop
+                )
+                exited_at = time.monotonic()
+                _SESSION_SECONDS.observe(exited_at - start_time, vmid)
+                if stop is not None and stop.is_set():
+                    logging.info(f"remote viewer for vm {vmid} stopped")
+                    return
+                if not restart:
+                    logging.info(f"remote viewer for vm {vmid} finished")
+                    return exitcode
+                run_time = exited_at - start_time
+                delay = restart_backoff.next_delay(run_time)
+                if warm and run_time >= restart_backoff.healthy_after:
+                    # the session ended normally (disconnect): reconnect right away
+                    delay = 0.0
+                if not warm:
+                    location = None
+                    ticket = None
+                if delay > 0:
+                    logging.info(f"restarting remote viewer for vm {vmid} in {delay:.1f} seconds")
+                    if stop is None:
+                        time.sleep(delay)
+                    elif stop.wait(delay):
+                        return
+
+    def _locate(self, vmid: Optional[int], node: Optional[str]) -> Tuple[int, str]:
+        with self._prepared_lock:
+            prepared = self._prepared.pop((vmid, node), None)
+        if prepared is not None:
+            with span("wait for proxmox lookup"):
+                return prepared.result()
+        with span("proxmox lookup"):
+            return self._resolve(vmid, node)
+
+    def _fetch_spice_ticket(self, location: Tuple[int, str],
+                            retry_cold: bool = False) -> Tuple[SpiceTicket, Tuple[int, str]]:
+        """
+        :param retry_cold: if the call fails, look the VM up again in a fresh index and retry once;
+            used when `location` comes from a previous session and the VM may have moved
+        :return: the ticket and the location it was fetched for
+        """
+        vmid, node = location
+        proxy = None
+        if self._spice_proxy is not None:
+            with span("spice proxy selection"):
+                proxy = self._spice_proxy.select()
+        start = time.monotonic()
+        try:
+            with span("spiceproxy"):
+                data = self._spiceproxy(vmid, node, proxy)
+        except Exception as e:
+            if not retry_cold:
+                raise
+            logging.warning(f"cannot get a SPICE ticket for vm {vmid} on {node}: {e!r}, looking it up again")
+            self._resources.invalidate()
+            vmid, node = self._resolve(vmid, None)
+            start = time.monotonic()
+            data = self._spiceproxy(vmid, node, proxy)
+        fetched_at = time.monotonic()
+        logging.debug(f"SPICE ticket for vm {vmid} fetched in {(fetched_at - start) * 1000:.1f} ms")
+        return SpiceTicket(data, fetched_at), (vmid, node)
+
+    def _spiceproxy(self, vmid: int, node: str, proxy: Optional[str]) -> Dict[str, Any]:
+        if proxy is None:
+            return self._api_call(_SPICEPROXY, lambda api: api.nodes(node).qemu(vmid).spiceproxy.post())
+        data = self._api_call(_SPICEPROXY, lambda api: api.nodes(node).qemu(vmid).spiceproxy.post(proxy=proxy))
+        # the server builds the same url from the parameter; set it so the .vv file never disagrees
+        data['proxy'] = proxy_url(proxy, self._spice_proxy.port)
+        logging.info(f"using spice proxy {data['proxy']}")
+        return data
+
+    def _run_remote_viewer(self,
+                           location: Tuple[int, str],
+                           ticket: SpiceTicket,
+                           args: Optional[List[str]] = None,
+                           prefetch_interval: Optional[float] = None,
+                           stop: Optional[threading.Event] = None) -> Tuple[int, Optional[SpiceTicket]]:
+        """
+        Run remote-viewer until it exits, or until `stop` is set.
+
+        :return: the exit code of remote-viewer, and the last ticket fetched every `prefetch_interval`
+            seconds while it was running
+        """
+        fd = _connection_fd(ticket.data)
         if args is None:
             complete_args = []
         else:
             complete_args = args[:]
-        args.append(tmppath)
+        # pass_fds keeps the fd number in the child
+        complete_args.append(f"/proc/self/fd/{fd}")
         logging.info(f"exec '{self.remote_viewer_path}' {' '.join(complete_args)}")
+        prefetched = None
         try:
-            proc = subprocess.run([self.remote_viewer_path] + complete_args)
-            proc.check_returncode()
-        except subprocess.CalledProcessError:
-            pass
+            with span("remote-viewer exec"):
+                proc = subprocess.Popen([self.remote_viewer_path] + complete_args, pass_fds=(fd,))
         finally:
-            if os.path.exists(tmppath):
+            os.close(fd)
+        next_prefetch = time.monotonic() + prefetch_interval if prefetch_interval else None
+        while True:
+            timeouts = []
+            if stop is not None:
+                timeouts.append(_STOP_POLL_INTERVAL)
+            if next_prefetch is not None:
+                timeouts.append(max(0.0, next_prefetch - time.monotonic()))
+            try:
+                proc.wait(min(timeouts) if timeouts else None)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if stop is not None and stop.is_set():
+                logging.info("terminating remote viewer")
+                proc.terminate()
+                proc.wait()
+                break
+            if next_prefetch is not None and time.monotonic() >= next_prefetch:
                 try:
-                    os.remove(tmppath)
-                except Exception:
-                    pass
-
-            if restart:
-                logging.info(f"restarting remote viewer for vm {vmid}")
-                now = time.time()
-                if now - start_time < self._restart_delay:
-                    time.sleep(self._restart_delay - (now - start_time))
-                self.remote_viewer(vmid=vmid, node=node, args=args, restart=restart)
-            else:
-                logging.info(f"remote viewer for vm {vmid} finished")
+                    prefetched, _ = self._fetch_spice_ticket(location)
+                except Exception as e:
+                    logging.warning(f"cannot prefetch a SPICE ticket for vm {location[0]}: {e!r}")
+                next_prefetch = time.monotonic() + prefetch_interval
+        if proc.returncode != 0:
+            logging.info(f"remote viewer exit code: {proc.returncode}")
+        return proc.returncode, prefetched
 
 
 def main():
@@ -95,7 +597,24 @@ def main():
     # paramiko only backend
     parser.add_argument('--private-key-file', type=bool, default=None)
     # others
+    parser.add_argument('--resource-ttl', type=float, default=None,
+                        help='seconds the cluster resource index is kept before being refreshed')
+    parser.add_argument('--ticket-cache-dir', default=None,
+                        help='https backend: directory of the cached login ticket')
+    parser.add_argument('--spice-proxy', default=None,
+                        help="pick the SPICE proxy by connect time: 'cluster' or a comma separated host list")
+    parser.add_argument('--spice-proxy-ttl', type=float, default=None)
     parser.add_argument('--remote-viewer-path', default='/usr/bin/remote-viewer')
+    parser.add_argument('--restart', action='store_true', default=False)
+    parser.add_argument('--warm', action='store_true', default=False,
+                        help='on restart reuse the VM location of the previous session')
+    parser.add_argument('--prefetch-interval', type=float, default=None,
+                        help='with --warm, seconds between SPICE ticket prefetches while the viewer runs; '
+                             'below 25, the lifetime of a ticket')
+    parser.add_argument('--wait', action='store_true', default=False,
+                        help='wait for the VM to run instead of failing')
+    parser.add_argument('--start', action='store_true', default=False,
+                        help='with --wait, start the VM if it is stopped')
     parser.add_argument('viewer_args', nargs=argparse.ZERO_OR_MORE, default=[
         '--full-screen',
         '--debug', '--spice-debug', '--kiosk', '--kiosk-quit=on-disconnect'
@@ -104,15 +623,24 @@ def main():
     vmid = cmd_args.vmid
     node = cmd_args.node
     viewer_args = cmd_args.viewer_args
+    restart = cmd_args.restart
+    warm = cmd_args.warm
+    prefetch_interval = parse_prefetch_interval(cmd_args.prefetch_interval)
+    wait = cmd_args.wait
+    start = cmd_args.start
     kwargs = vars(cmd_args)
-    del kwargs['vmid']
-    del kwargs['node']
-    del kwargs['viewer_args']
+    for k in ('vmid', 'node', 'viewer_args', 'restart', 'warm', 'prefetch_interval', 'wait', 'start'):
+        del kwargs[k]
     logging.basicConfig(level=logging.DEBUG)
     ProxmoxViewer(**kwargs).remote_viewer(
         vmid=vmid,
         node=node,
-        args=viewer_args
+        args=viewer_args,
+        restart=restart,
+        warm=warm,
+        prefetch_interval=prefetch_interval,
+        wait_running=wait,
+        auto_start=start
     )
 
 
@@ -0,0 +1,349 @@
+# Path: replay.py
+"""
+Recording of the X events an MWM receives, and replay of a recording into the handlers of an MWM
+attached to another X server (Xvfb), as fast as possible or in real time.
+
+    proxmox-desktop --record-events /var/log/proxmox-desktop/{vt}.events ...
+    python -m proxmox_desktop.replay --xvfb --profile replay.prof /var/log/proxmox-desktop/8.events
+
+Format: the magic header, then records of a `<dHH` header (seconds since the start of the recording,
+type index, payload length) and the payload. Type index 0xFFFF defines the next type index, its payload
+being "module:ClassName"; 0xFFFE defines an atom, `<I` id then name, ahead of the first event using it;
+0xFFFD gives the `<I` root window. Other payloads are the event as packed by xcffib. Events of the same
+batch share their timestamp.
+
+Window ids and atoms only mean something on the recording server: on replay, the recorded root is mapped
+to the live root, other windows to stand-in windows and atoms to the atoms of the same name.
+"""
+import argparse
+import importlib
+import json
+import logging
+import struct
+import threading
+import time
+from typing import Any, BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import xcffib
+import xcffib.xproto
+
+__all__ = ['EventRecorder', 'Recording', 'read_recording', 'replay', 'main']
+
+MAGIC = b"PDXEVT2\0"
+
+_RECORD = struct.Struct("<dHH")
+_ID = struct.Struct("<I")
+# type indexes of the records defining something instead of holding an event
+_DEFINE_TYPE = 0xFFFF
+_DEFINE_ATOM = 0xFFFE
+_DEFINE_ROOT = 0xFFFD
+
+# event attributes holding a window id, remapped to the stand-in windows on replay
+_WINDOW_FIELDS = ('window', 'event', 'parent', 'above_sibling', 'sibling', 'requestor', 'owner')
+# event attributes holding an atom; the type of a ClientMessageEvent is one as well
+_ATOM_FIELDS = ('atom', 'selection', 'target', 'property')
+# data32 items holding an atom, by client message type
+_CLIENT_MESSAGE_ATOMS = {
+    '_NET_WM_STATE': (1, 2),
+}
+
+
+def _event_atoms(event: Any, names: Dict[int, Optional[str]]) -> Iterable[Tuple[str, Optional[int], int]]:
+    """
+    :param names: atom -> name, for the client message types
+    :return: (attribute, data32 index or None, atom) of every atom in the event
+    """
+    for field in _ATOM_FIELDS:
+        atom = getattr(event, field, None)
+        if atom:
+            yield field, None, atom
+    if isinstance(event, xcffib.xproto.ClientMessageEvent):
+        yield 'type', None, event.type
+        if event.format == 32:
+            data = event.data.data32
+            for i in _CLIENT_MESSAGE_ATOMS.get(names.get(event.type), ()):
+                if data[i]:
+                    yield 'data32', i, data[i]
+
+
+class EventRecorder:
+    """
+    Appends batches of events to a recording. Writes are buffered; events without `pack` are counted and skipped.
+    The names of the atoms in the events are asked to the server over `conn` (a round trip per new atom).
+    """
+
+    def __init__(self, path: str, conn: xcffib.Connection, root: int):
+        self.path = path
+        self._conn = conn
+        self._file: BinaryIO = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._write(_DEFINE_ROOT, _ID.pack(root))
+        self._types: Dict[type, int] = {}
+        # atom -> name, None for values that are not atoms
+        self._atoms: Dict[int, Optional[str]] = {}
+        self._origin = time.monotonic()
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.skipped = 0
+
+    def _write(self, index: int, payload: bytes, t: float = 0.0):
+        self._file.write(_RECORD.pack(t, index, len(payload)))
+        self._file.write(payload)
+
+    def _type_index(self, event_type: type) -> int:
+        index = self._types.get(event_type)
+        if index is None:
+            index = self._types[event_type] = len(self._types)
+            self._write(_DEFINE_TYPE, f"{event_type.__module__}:{event_type.__name__}".encode())
+        return index
+
+    def _define_atom(self, atom: int):
+        if atom in self._atoms:
+            return
+        try:
+            name = self._conn.core.GetAtomName(atom).reply().name.to_string()
+        except xcffib.ProtocolException:
+            name = None
+        self._atoms[atom] = name
+        if name is not None:
+            self._write(_DEFINE_ATOM, _ID.pack(atom) + name.encode())
+
+    def _define_atoms(self, event: Any):
+        if isinstance(event, xcffib.xproto.ClientMessageEvent):
+            # its name tells which data items are atoms
+            self._define_atom(event.type)
+        for _, _, atom in _event_atoms(event, self._atoms):
+            self._define_atom(atom)
+
+    def write_batch(self, received_at: float, events: List[Any]):
+        t = received_at - self._origin
+        with self._lock:
+            if self._file is None:
+                return
+            for event in events:
+                try:
+                    payload = event.pack()
+                except Exception:
+                    self.skipped += 1
+                    continue
+                self._define_atoms(event)
+                self._write(self._type_index(type(event)), payload, t)
+                self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        logging.info(f"recorded {self.recorded} X events to {self.path} ({self.skipped} skipped)")
+
+
+class Recording(NamedTuple):
+    # (seconds since the start of the recording, events) of every batch
+    batches: List[Tuple[float, List[Any]]]
+    # recorded atom -> name
+    atoms: Dict[int, str]
+    # root window of the recorded screen
+    root: Optional[int]
+
+
+def read_recording(path: str) -> Recording:
+    batches: List[Tuple[float, List[Any]]] = []
+    atoms: Dict[int, str] = {}
+    root = None
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an X event recording of this version")
+        types: List[type] = []
+        batch: List[Any] = []
+        batch_time: Optional[float] = None
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            t, index, length = _RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                logging.warning(f"{path}: truncated record")
+                break
+            if index == _DEFINE_TYPE:
+                module, name = payload.decode().split(':', 1)
+                types.append(getattr(importlib.import_module(module), name))
+                continue
+            if index == _DEFINE_ATOM:
+                atoms[_ID.unpack_from(payload)[0]] = payload[_ID.size:].decode()
+                continue
+            if index == _DEFINE_ROOT:
+                root = _ID.unpack(payload)[0]
+                continue
+            if batch_time is not None and t != batch_time:
+                batches.append((batch_time, batch))
+                batch = []
+            batch_time = t
+            batch.append(types[index](xcffib.MemoryUnpacker(payload)))
+        if batch:
+            batches.append((batch_time, batch))
+    return Recording(batches, atoms, root)
+
+
+class _StandIns:
+    """
+    Windows created on the replay server in place of the recorded ones, so that the requests of the handlers
+    hit existing windows instead of failing with BadWindow, and the atoms of the recording interned there.
+    """
+
+    def __init__(self, display: str, recording: Recording):
+        self.conn = xcffib.connect(display=display)
+        self.screen = self.conn.get_setup().roots[0]
+        self._windows: Dict[int, int] = {}
+        if recording.root is not None:
+            self._windows[recording.root] = self.screen.root
+        self._names = recording.atoms
+        cookies = {
+            atom: self.conn.core.InternAtom(False, len(name), name) for atom, name in recording.atoms.items()
+        }
+        self._atoms: Dict[int, int] = {atom: cookie.reply().atom for atom, cookie in cookies.items()}
+
+    def remap(self, event: Any):
+        for field in _WINDOW_FIELDS:
+            recorded = getattr(event, field, None)
+            if not recorded:
+                continue
+            window = self._windows.get(recorded)
+            if window is None:
+                window = self._windows[recorded] = self._create(event)
+            setattr(event, field, window)
+        # collected first: the data items of a client message depend on its recorded type
+        for field, index, recorded in list(_event_atoms(event, self._names)):
+            atom = self._atoms.get(recorded)
+            if atom is None:
+                continue
+            if index is None:
+                setattr(event, field, atom)
+            else:
+                data = list(event.data.data32)
+                data[index] = atom
+                event.data.data32 = data
+
+    def _create(self, event: Any) -> int:
+        window = self.conn.generate_id()
+        self.conn.core.CreateWindow(
+            self.screen.root_depth, window, self.screen.root,
+            getattr(event, 'x', 0), getattr(event, 'y', 0),
+            max(1, getattr(event, 'width', 1)), max(1, getattr(event, 'height', 1)), 0,
+            xcffib.xproto.WindowClass.InputOutput,
+            self.screen.root_visual,
+            xcffib.xproto.CW.OverrideRedirect,
+            [int(bool(getattr(event, 'override_redirect', False)))]
+        )
+        return window
+
+    def close(self):
+        self.conn.disconnect()
+
+
+def _event_stats(wm) -> Dict[str, Any]:
+    return {
+        s.name: {
+            'count': s.count,
+            'avg_us': round(s.total_time / s.count * 1e6, 1) if s.count else 0.0,
+            'max_us': round(s.max_time * 1e6, 1),
+        }
+        for s in wm.event_stats()
+    }
+
+
+def replay(path: str, display: str, realtime: bool = False, speed: float = 1.0) -> Dict[str, Any]:
+    """
+    Feed a recording, batch by batch, to the handlers of an MWM attached to `display`, without its viewer.
+    The events the server sends back because of the replay are read and dropped between batches.
+    Times are in milliseconds.
+    """
+    from proxmox_desktop.bench import FakeProxmoxAPI
+    from proxmox_desktop.proxmox_desktop import MWM
+    from proxmox_desktop.proxmox_viewer import ProxmoxViewer
+
+    recording = read_recording(path)
+    batches = recording.batches
+    events = sum(len(batch) for _, batch in batches)
+    wm = MWM(0, display=display, run_xserver=False, proxmox=ProxmoxViewer(api=FakeProxmoxAPI({})))
+    stand_ins = _StandIns(display, recording)
+    try:
+        wm.init()
+        for _, batch in batches:
+            for event in batch:
+                stand_ins.remap(event)
+        # round trip: the stand-in windows exist before the first request of the handlers
+        stand_ins.conn.core.GetInputFocus().reply()
+        wm.get_events(timeout=0)
+
+        start = time.monotonic()
+        handling = 0.0
+        for t, batch in batches:
+            if realtime:
+                delay = start + t / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            batch_start = time.monotonic()
+            wm.process_events(batch)
+            handling += time.monotonic() - batch_start
+            wm.get_events(timeout=0)
+        elapsed = time.monotonic() - start
+        stats = _event_stats(wm)
+    finally:
+        stand_ins.close()
+        wm.__exit__(None, None, None)
+    return {
+        'batches': len(batches),
+        'events': events,
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'handling_ms': round(handling * 1000, 3),
+        'events_per_second': round(events / handling, 1) if handling else None,
+        'event_stats': stats,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='proxmox-desktop-replay', description=__doc__.split('\n\n')[0])
+    parser.add_argument('recording')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--display', help='X server to replay against, e.g. an Xvfb already running')
+    target.add_argument('--xvfb', action='store_true', help='start Xvfb for the replay')
+    parser.add_argument('--realtime', action='store_true', default=False,
+                        help='keep the recorded time between batches instead of replaying as fast as possible')
+    parser.add_argument('--speed', type=float, default=1.0, help='with --realtime, speed up the replay by this factor')
+    parser.add_argument('--profile', default=None, help='write the cProfile stats of the replay to this file')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+
+    xvfb = None
+    display = args.display
+    if args.xvfb:
+        from proxmox_desktop.bench import start_xvfb
+        xvfb, display = start_xvfb()
+    try:
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            report = profiler.runcall(replay, args.recording, display, realtime=args.realtime, speed=args.speed)
+            profiler.dump_stats(args.profile)
+        else:
+            report = replay(args.recording, display, realtime=args.realtime, speed=args.speed)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
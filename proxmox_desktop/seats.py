@@ -0,0 +1,100 @@
+# Path: seats.py
+import configparser
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from proxmox_desktop.backoff import Backoff
+from proxmox_desktop.proxmox_desktop import MWM
+from proxmox_desktop.proxmox_viewer import ProxmoxViewer
+
+__all__ = ['Seat', 'SeatDaemon', 'seats_from_config']
+
+
+def seats_from_config(config: configparser.ConfigParser) -> Dict[int, int]:
+    """
+    :return: vt -> vmid for every `ttyN` entry of the [vm] section
+    """
+    seats = {}
+    if 'vm' not in config:
+        return seats
+    for key in config['vm']:
+        if key.startswith('tty') and key[3:].isdigit():
+            seats[int(key[3:])] = config['vm'].getint(key)
+    return seats
+
+
+class Seat(threading.Thread):
+    """
+    Runs the MWM of one tty, and a new one after the delay given by its Backoff whenever it ends.
+    An MWM owns its Xorg, X connection and child processes, so the failure of a seat leaves the other seats running.
+    """
+
+    def __init__(self, vt: int, vmid: int, proxmox: ProxmoxViewer, stopping: threading.Event, **mwm_kwargs):
+        super().__init__(name=f"seat-tty{vt}", daemon=True)
+        self.vt = vt
+        self.vmid = vmid
+        self.backoff = Backoff(f"seat tty{vt}")
+        self.wm: Optional[MWM] = None
+        self._proxmox = proxmox
+        self._stopping = stopping
+        self._mwm_kwargs = mwm_kwargs
+
+    def run(self):
+        while not self._stopping.is_set():
+            start = time.monotonic()
+            try:
+                with MWM(self.vmid, vt=self.vt, display=f":{self.vt}", proxmox=self._proxmox,
+                         **self._mwm_kwargs) as wm:
+                    self.wm = wm
+                    wm.start()
+                    wm.join()
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                self.wm = None
+            if self._stopping.is_set():
+                return
+            delay = self.backoff.next_delay(time.monotonic() - start)
+            logging.warning(f"seat tty{self.vt} ended, restarting it in {delay:.1f} seconds")
+            self._stopping.wait(delay)
+
+    def stop(self):
+        wm = self.wm
+        if wm is not None:
+            wm.stop()
+
+
+class SeatDaemon:
+    """
+    Drives every seat from a single process, sharing one ProxmoxViewer (API client, login ticket and
+    cluster index) between them.
+    """
+
+    def __init__(self, seats: Dict[int, int], proxmox: ProxmoxViewer, **mwm_kwargs: Any):
+        """
+        :param seats: vt -> vmid
+        :param mwm_kwargs: options passed to every MWM
+        """
+        self._stopping = threading.Event()
+        self.seats: List[Seat] = [
+            Seat(vt, vmid, proxmox, self._stopping, **mwm_kwargs) for vt, vmid in sorted(seats.items())
+        ]
+
+    def wms(self) -> List[MWM]:
+        return [seat.wm for seat in self.seats if seat.wm is not None]
+
+    def start(self):
+        for seat in self.seats:
+            logging.info(f"starting seat tty{seat.vt} for vm {seat.vmid}")
+            seat.start()
+
+    def join(self):
+        for seat in self.seats:
+            seat.join()
+
+    def stop(self):
+        self._stopping.set()
+        for seat in self.seats:
+            seat.stop()
@@ -0,0 +1,98 @@
+# Path: spice_proxy.py
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+__all__ = ['SpiceProxySelector', 'SPICE_PROXY_PORT']
+
+# port spiceproxy listens on, on every PVE node
+SPICE_PROXY_PORT = 3128
+
+
+def proxy_url(host: str, port: int = SPICE_PROXY_PORT) -> str:
+    if ':' in host:
+        host = f"[{host}]"
+    return f"http://{host}:{port}"
+
+
+class SpiceProxySelector:
+    """
+    Picks the SPICE proxy with the lowest TCP connect time among the candidates, measured in parallel.
+    The ranking is kept for `ttl` seconds; once stale the cached choice is still returned while a new
+    measurement runs in the background, so only the very first selection waits for it.
+    """
+
+    def __init__(self,
+                 candidates: Callable[[], Sequence[str]],
+                 port: int = SPICE_PROXY_PORT,
+                 timeout: float = 1.0,
+                 ttl: float = 300.0):
+        """
+        :param candidates: returns the proxy hosts to measure, e.g. a fixed list or the cluster nodes
+        :param timeout: seconds after which a host is considered unreachable
+        """
+        self._candidates = candidates
+        self.port = port
+        self.timeout = timeout
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ranking: Optional[List[Tuple[float, str]]] = None
+        self._measured_at = 0.0
+        self._refreshing = False
+
+    def _connect_time(self, host: str) -> Optional[float]:
+        start = time.monotonic()
+        try:
+            with socket.create_connection((host, self.port), timeout=self.timeout):
+                return time.monotonic() - start
+        except OSError as e:
+            logging.debug(f"spice proxy {host}:{self.port} unreachable: {e}")
+            return None
+
+    def measure(self) -> List[Tuple[float, str]]:
+        """
+        :return: (connect time, host) of the reachable candidates, fastest first
+        """
+        hosts = list(dict.fromkeys(self._candidates()))
+        if not hosts:
+            return []
+        with ThreadPoolExecutor(max_workers=len(hosts), thread_name_prefix="spice-proxy-rtt") as pool:
+            times = list(pool.map(self._connect_time, hosts))
+        ranking = sorted((t, host) for t, host in zip(times, hosts) if t is not None)
+        logging.info(
+            "spice proxy ranking: " + (", ".join(f"{host} {t * 1000:.1f} ms" for t, host in ranking) or "none reachable")
+        )
+        return ranking
+
+    def refresh(self) -> List[Tuple[float, str]]:
+        try:
+            ranking = self.measure()
+        except Exception as e:
+            logging.warning(f"cannot measure the spice proxies: {e!r}")
+            ranking = []
+        with self._lock:
+            self._ranking = ranking
+            self._measured_at = time.monotonic()
+            self._refreshing = False
+        return ranking
+
+    def select(self) -> Optional[str]:
+        """
+        :return: the fastest reachable proxy host, or None to let the server choose
+        """
+        with self._lock:
+            ranking = self._ranking
+            stale = time.monotonic() - self._measured_at >= self.ttl
+            if ranking is not None and stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self.refresh, name="spice-proxy-refresh", daemon=True).start()
+        if ranking is None:
+            ranking = self.refresh()
+        return ranking[0][1] if ranking else None
+
+    def invalidate(self):
+        with self._lock:
+            self._measured_at = 0.0
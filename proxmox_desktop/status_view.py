@@ -0,0 +1,139 @@
+# Path: status_view.py
+from typing import Optional, Tuple
+
+import xcffib
+import xcffib.xproto
+
+__all__ = ['StatusView']
+
+Rect = Tuple[int, int, int, int]
+
+
+def _union(a: Optional[Rect], b: Rect) -> Rect:
+    if a is None:
+        return b
+    x1 = min(a[0], b[0])
+    y1 = min(a[1], b[1])
+    x2 = max(a[0] + a[2], b[0] + b[2])
+    y2 = max(a[1] + a[3], b[1] + b[3])
+    return x1, y1, x2 - x1, y2 - y1
+
+
+def _intersect(a: Rect, b: Rect) -> Optional[Rect]:
+    x1 = max(a[0], b[0])
+    y1 = max(a[1], b[1])
+    x2 = min(a[0] + a[2], b[0] + b[2])
+    y2 = min(a[1] + a[3], b[1] + b[3])
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return x1, y1, x2 - x1, y2 - y1
+
+
+class StatusView:
+    """
+    Single line of text centered on the status window.
+
+    The line is rendered into an off-screen pixmap as tall as the font and copied to the window
+    only where it has been damaged; the rest of the window is the window background, which the
+    server repaints on its own. Damage is accumulated until `flush()`, so a run of Expose events
+    costs a single copy.
+    """
+
+    def __init__(self, conn: xcffib.Connection, screen, window: int):
+        self._conn = conn
+        self._screen = screen
+        self._window = window
+        self._width = screen.width_in_pixels
+        self._height = screen.height_in_pixels
+        self._text = ""
+        self._dirty = True
+        self._damage: Optional[Rect] = None
+        self._pixmap: Optional[int] = None
+        self._pixmap_size: Tuple[int, int] = (0, 0)
+
+        # no GraphicsExpose/NoExpose events for the CopyArea from the pixmap
+        self.gc = conn.generate_id()
+        conn.core.CreateGC(
+            self.gc,
+            window,
+            xcffib.xproto.GC.Foreground | xcffib.xproto.GC.Background | xcffib.xproto.GC.GraphicsExposures,
+            [screen.black_pixel, screen.white_pixel, 0]
+        )
+        self._background_gc = conn.generate_id()
+        conn.core.CreateGC(
+            self._background_gc,
+            window,
+            xcffib.xproto.GC.Foreground | xcffib.xproto.GC.GraphicsExposures,
+            [screen.white_pixel, 0]
+        )
+        # text metrics of the default font, queried once
+        font = conn.core.QueryFont(self.gc).reply()
+        self._ascent = font.font_ascent
+        self._line_height = font.font_ascent + font.font_descent
+        self._char_width = font.max_bounds.character_width
+
+    @property
+    def band(self) -> Rect:
+        """
+        Area of the window covered by the text line: the baseline is at half the window height.
+        """
+        return (
+            0,
+            int(self._height / 2) - self._ascent,
+            self._width,
+            self._line_height
+        )
+
+    def resize(self, width: int, height: int):
+        if (width, height) != (self._width, self._height):
+            self._width = width
+            self._height = height
+            self._dirty = True
+
+    def set_text(self, text: str):
+        # ImageText8 is limited to 255 characters
+        text = text[:255]
+        if text != self._text:
+            self._text = text
+            self._dirty = True
+
+    def damage(self, x: int, y: int, width: int, height: int):
+        self._damage = _union(self._damage, (x, y, width, height))
+
+    def flush(self):
+        """
+        Render the text if it changed and copy the damaged part of the line to the window.
+        Requests are not flushed to the server.
+        """
+        band = self.band
+        if self._dirty:
+            self._render(band[2], band[3])
+            self._dirty = False
+            self._damage = _union(self._damage, band)
+        if self._damage is None:
+            return
+        area = _intersect(self._damage, band)
+        self._damage = None
+        if area is None:
+            return
+        x, y, width, height = area
+        self._conn.core.CopyArea(
+            self._pixmap, self._window, self.gc,
+            x - band[0], y - band[1],
+            x, y,
+            width, height
+        )
+
+    def _render(self, width: int, height: int):
+        if self._pixmap is None or self._pixmap_size != (width, height):
+            if self._pixmap is not None:
+                self._conn.core.FreePixmap(self._pixmap)
+            self._pixmap = self._conn.generate_id()
+            self._conn.core.CreatePixmap(self._screen.root_depth, self._pixmap, self._window, width, height)
+            self._pixmap_size = (width, height)
+        self._conn.core.PolyFillRectangle(
+            self._pixmap, self._background_gc, 1, [xcffib.xproto.RECTANGLE.synthetic(0, 0, width, height)]
+        )
+        if self._text:
+            x = max(0, int((width - len(self._text) * self._char_width) / 2))
+            self._conn.core.ImageText8(len(self._text), self._pixmap, self.gc, x, self._ascent, self._text)
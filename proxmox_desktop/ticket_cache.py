@@ -0,0 +1,157 @@
+# Path: ticket_cache.py
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+from proxmoxer.backends.https import JsonSerializer, ProxmoxHTTPAuthBase, ProxmoxHttpSession
+from proxmoxer.core import ProxmoxResource
+from requests.cookies import cookiejar_from_dict
+
+__all__ = ['Ticket', 'TicketCache', 'TicketAuth', 'ticket_api']
+
+# pveproxy
+DEFAULT_PORT = 8006
+
+# PVE auth tickets are valid for 2 hours
+TICKET_LIFETIME = 7200
+
+
+class Ticket(NamedTuple):
+    ticket: str
+    csrf_token: str
+
+    @property
+    def issued_at(self) -> int:
+        """
+        Unix time the ticket was issued at, encoded in hex in the ticket itself (PVE:user@realm:HEXTIME::sig).
+        """
+        try:
+            return int(self.ticket.split(':')[2], 16)
+        except (IndexError, ValueError):
+            return 0
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.issued_at
+
+
+def _default_cache_dir() -> Path:
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return Path(runtime_dir) / 'proxmox-desktop'
+    return Path(os.getenv('XDG_CACHE_HOME', Path.home() / '.cache')) / 'proxmox-desktop'
+
+
+class TicketCache:
+    """
+    PVEAuthCookie ticket and CSRF token of a host/user pair, kept on disk so that a restarted
+    process can skip the login while the ticket is valid. The directory is created 0700 and
+    the file 0600; a file readable by others, or owned by another user, is ignored.
+    """
+
+    def __init__(self, host: str, user: str, cache_dir: Optional[Path] = None, max_age: float = TICKET_LIFETIME - 600):
+        self.max_age = max_age
+        self._dir = Path(cache_dir) if cache_dir is not None else _default_cache_dir()
+        key = hashlib.sha256(f"{host}\0{user}".encode()).hexdigest()[:16]
+        self.path = self._dir / f"ticket-{key}.json"
+
+    def load(self) -> Optional[Ticket]:
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning(f"cannot open ticket cache {self.path}: {e}")
+            return None
+        with os.fdopen(fd) as f:
+            st = os.fstat(f.fileno())
+            if st.st_uid != os.getuid() or st.st_mode & 0o077:
+                logging.warning(f"ignoring ticket cache {self.path}: wrong owner or permissions")
+                return None
+            try:
+                data = json.load(f)
+                ticket = Ticket(data['ticket'], data['csrf_token'])
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f"ignoring malformed ticket cache {self.path}")
+                return None
+        if ticket.age >= self.max_age:
+            logging.info("cached ticket expired")
+            return None
+        return ticket
+
+    def save(self, ticket: Ticket):
+        self._dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        os.chmod(self._dir, 0o700)
+        tmp = self._dir / f".{self.path.name}.{os.getpid()}"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'ticket': ticket.ticket, 'csrf_token': ticket.csrf_token}, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class TicketAuth(ProxmoxHTTPAuthBase):
+    """
+    Authenticates the requests of a proxmoxer https session with an existing PVE ticket, without logging in.
+    """
+
+    def __init__(self, ticket: Ticket, timeout: float = 5, service: str = "PVE", verify_ssl: Union[bool, str] = True):
+        super().__init__(timeout=timeout, service=service, verify_ssl=verify_ssl)
+        self.ticket = ticket
+
+    def get_cookies(self):
+        return cookiejar_from_dict({f"{self.service}AuthCookie": self.ticket.ticket})
+
+    def get_tokens(self):
+        return self.ticket.ticket, self.ticket.csrf_token
+
+    def __call__(self, r):
+        # like proxmoxer's password auth: the CSRF token only goes with the requests that need it
+        if r.method != 'GET':
+            r.headers['CSRFPreventionToken'] = self.ticket.csrf_token
+        return r
+
+
+def _base_url(host: str, port: Optional[int], path_prefix: Optional[str]) -> str:
+    # same host forms as proxmoxer: name, name:port, IPv6, [IPv6]:port
+    if host.count(':') > 1:
+        if not host.startswith('['):
+            host = f"[{host}]"
+        elif ']:' in host:
+            host, _, host_port = host.rpartition(':')
+            port = int(host_port)
+    elif ':' in host:
+        host, _, host_port = host.partition(':')
+        port = int(host_port)
+    prefix = f"/{path_prefix}" if path_prefix else ""
+    return f"https://{host}:{port or DEFAULT_PORT}{prefix}/api2/json"
+
+
+def ticket_api(auth: TicketAuth, host: str, port: Optional[int] = None,
+               path_prefix: Optional[str] = None) -> ProxmoxResource:
+    """
+    API client of the https backend authenticated by `auth`. ProxmoxAPI cannot be built without credentials
+    it logs in with, so the client is the root resource over a keep-alive session, as ProxmoxAPI sets it up.
+    """
+    serializer = JsonSerializer()
+    session = ProxmoxHttpSession()
+    session.auth = auth
+    session.headers['Connection'] = 'keep-alive'
+    session.headers['accept'] = serializer.get_accept_types()
+    return ProxmoxResource(base_url=_base_url(host, port, path_prefix), session=session, serializer=serializer)
@@ -0,0 +1,156 @@
+# Path: timeline.py
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+__all__ = ['Span', 'Timeline', 'activate', 'span']
+
+
+class Span(NamedTuple):
+    name: str
+    # seconds since the start of the timeline, monotonic clock
+    start: float
+    end: float
+    thread: str
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Timeline:
+    """
+    Named spans of a boot, on the monotonic clock, from the creation of the timeline to `finish`.
+    Spans can be recorded from any thread; those ending after `finish` are dropped.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.origin = time.monotonic()
+        self.wall_origin = time.time()
+        self.finished_at: Optional[float] = None
+        self._spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, end: float):
+        """
+        :param start: monotonic time the span started at
+        :param end: monotonic time the span ended at
+        """
+        with self._lock:
+            if self.finished_at is not None:
+                return
+            self._spans.append(Span(name, start - self.origin, end - self.origin, threading.current_thread().name))
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic())
+
+    def mark(self, name: str):
+        now = time.monotonic()
+        self.add(name, now, now)
+
+    def finish(self) -> bool:
+        """
+        End the timeline and log it as a single record; the journal gets the JSON in the STARTUP_TIMELINE field.
+        :return: False if it was already finished
+        """
+        with self._lock:
+            if self.finished_at is not None:
+                return False
+            self.finished_at = time.monotonic() - self.origin
+        logging.info(
+            f"{self.name}: startup took {self.finished_at * 1000:.1f} ms",
+            extra={'STARTUP_TIMELINE': json.dumps(self.to_json())}
+        )
+        return True
+
+    @property
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return sorted(self._spans, key=lambda s: s.start)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'started_at': self.wall_origin,
+            'total_ms': None if self.finished_at is None else round(self.finished_at * 1000, 3),
+            'spans': [
+                {
+                    'name': s.name,
+                    'start_ms': round(s.start * 1000, 3),
+                    'duration_ms': round(s.duration * 1000, 3),
+                    'thread': s.thread,
+                }
+                for s in self.spans
+            ],
+        }
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """
+        :return: the spans in the Chrome trace event format (chrome://tracing, Perfetto)
+        """
+        pid = os.getpid()
+        threads: Dict[str, int] = {}
+        events = []
+        for s in self.spans:
+            tid = threads.setdefault(s.thread, len(threads) + 1)
+            event = {'name': s.name, 'cat': self.name, 'ts': round(s.start * 1e6), 'pid': pid, 'tid': tid}
+            if s.duration > 0:
+                event.update(ph='X', dur=round(s.duration * 1e6))
+            else:
+                # instant event, thread scoped
+                event.update(ph='i', s='t')
+            events.append(event)
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def format_table(self) -> str:
+        lines = [f"{'span':<32} {'start ms':>10} {'duration ms':>12}  thread"]
+        for s in self.spans:
+            lines.append(f"{s.name:<32} {s.start * 1000:>10.1f} {s.duration * 1000:>12.1f}  {s.thread}")
+        if self.finished_at is not None:
+            lines.append(f"{'total':<32} {0.0:>10.1f} {self.finished_at * 1000:>12.1f}")
+        return "\n".join(lines)
+
+
+_current = threading.local()
+
+
+@contextlib.contextmanager
+def activate(timeline: Optional[Timeline]) -> Iterator[None]:
+    """
+    Make `timeline` the one `span` records on, for the current thread.
+    """
+    previous = getattr(_current, 'timeline', None)
+    _current.timeline = timeline
+    try:
+        yield
+    finally:
+        _current.timeline = previous
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Record a span on the timeline active in the current thread, if any.
+    """
+    timeline = getattr(_current, 'timeline', None)
+    if timeline is None:
+        yield
+        return
+    with timeline.span(name):
+        yield
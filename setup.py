@@ -21,6 +21,8 @@ setup(
         'console_scripts': [
             'proxmox-desktop = proxmox_desktop.proxmox_desktop:main',
             'proxmox-viewer = proxmox_desktop.proxmox_viewer:main',
+            'proxmox-desktop-bench = proxmox_desktop.bench:main',
+            'proxmox-desktop-replay = proxmox_desktop.replay:main',
             'test-pycharm-debugger = proxmox_desktop.test_debugger:main'
         ]
     }